@@ -0,0 +1,192 @@
+'''
+Benchmarks of the image pipeline. Run from the root of the repository:
+
+    python -m benchmarks.bench real CORPUS_DIRECTORY [--jobs JOBS] [--backend {wand,vips}] [--repeat REPEAT]
+    python -m benchmarks.bench mock [--images IMAGES] [--repeat REPEAT]
+
+The `real` mode runs `process_images` over every directory of the synthetic corpus (see `benchmarks.corpus`),
+generating it first if needed. The `mock` mode runs `process_images` with ImageMagick replaced by the mocks
+of the tests, hence only measures the overhead of h2kf itself. Both modes report the throughput, the
+percentiles of the latency of each image and the peak resident set size.
+'''
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import resource
+import threading
+import contextlib
+from unittest import mock
+
+from src.h2kf import image as h2kf_image
+from src.h2kf.image import process_images, IMAGE_PATTERN
+from src.h2kf.profile import percentile
+from src.h2kf.constants import BACKEND_NAMES
+from benchmarks.corpus import generate_corpus
+
+class PeakRSS:
+    '''
+    Samples the resident set size of the process in a background thread to find its peak while
+    the context is active. Falls back to the peak of the lifetime of the process where `/proc` is
+    not available.
+    '''
+    INTERVAL: float = 0.01 # seconds
+
+    def __init__(self):
+        self.peak: int               = 0 # bytes
+        self._stop: threading.Event  = threading.Event()
+        self._thread                 = threading.Thread(target = self._sample, daemon = True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self) -> None:
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        while True:
+            try:
+                with open("/proc/self/statm") as f:
+                    rss = int(f.read().split()[1]) * page_size
+            except OSError:
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            self.peak = max(self.peak, rss)
+            if self._stop.wait(self.INTERVAL):
+                return
+
+def run(name: str, repeat: int, jobs: int, count: int, **kwargs) -> dict:
+    '''
+    Run `process_images` `repeat` times with `kwargs` and report the metrics.
+
+    The latency of each image is measured around `ImageProcessor.convert_file`, which is only possible when
+    images are converted in this process, i.e. when `jobs` is `1`.
+
+    :param: name  (str) -- The name of the benchmark in the report.
+    :param: count (int) -- The amount of images converted by every run.
+    '''
+    latencies: list[float] = []
+    convert = h2kf_image.ImageProcessor.convert_file
+    def timed(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return convert(self, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    elapsed: float = 0
+    with PeakRSS() as rss:
+        for _ in range(repeat):
+            with mock.patch.object(h2kf_image.ImageProcessor, 'convert_file', timed) if jobs == 1 else contextlib.nullcontext():
+                start = time.perf_counter()
+                process_images(jobs = jobs, **kwargs)
+                elapsed += time.perf_counter() - start
+    return {
+        "name":          name,
+        "images":        count * repeat,
+        "images/s":      count * repeat / elapsed,
+        "p50 ms":        percentile(latencies, 50) * 1000,
+        "p95 ms":        percentile(latencies, 95) * 1000,
+        "p99 ms":        percentile(latencies, 99) * 1000,
+        "peak RSS MB":   rss.peak / 1000000,
+        "children MB":   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1000
+    }
+
+def bench_real(corpus: str, repeat: int, jobs: int, backend: str = "wand") -> list[dict]:
+    results: list[dict] = []
+    for directory in generate_corpus(corpus):
+        count = len([name for name in os.listdir(directory) if IMAGE_PATTERN.search(name)])
+        out_directory = tempfile.mkdtemp()
+        try:
+            results.append(run(
+                os.path.basename(directory),
+                repeat,
+                jobs,
+                count,
+                src_directory      = directory,
+                out_directory      = out_directory,
+                file_id            = "BENCH",
+                date               = "10-08-2022",
+                generate_timestamp = False,
+                backend            = backend))
+        finally:
+            shutil.rmtree(out_directory)
+    return results
+
+def bench_mock(images: int, repeat: int) -> list[dict]:
+    # NOTE: the mocks are shared with the tests, which import ImageMagick through `wand` like the
+    # rest of h2kf. The mocks only replace the calls to ImageMagick.
+    from tests import test_convert as mocks
+    mocks.AMOUNT_FILES = images
+    patches = [
+        mock.patch('src.h2kf.backend.Image',          side_effect = mocks.m_Image),
+        mock.patch('src.h2kf.backend.Drawing',        side_effect = mocks.m_Drawing),
+        mock.patch('src.h2kf.image.os.path.getctime', side_effect = mocks.m_getctime),
+        mock.patch('src.h2kf.image.os.path.getsize',  side_effect = mocks.m_getsize),
+        mock.patch('src.h2kf.image.os.scandir',       side_effect = mocks.m_scandir_JPG),
+        mock.patch('src.h2kf.image._read_source',     side_effect = mocks.m_read_source),
+        mock.patch('src.h2kf.image._write_output',    side_effect = mocks.m_write_output)
+    ]
+    for patch in patches:
+        patch.start()
+    try:
+        return [run(
+            "mock",
+            repeat,
+            1,
+            images,
+            src_directory      = mocks.SRC_DIR,
+            out_directory      = mocks.OUT_DIR,
+            file_id            = mocks.FILE_ID,
+            generate_timestamp = True,
+            output_resolution  = mocks.OUT_RES)]
+    finally:
+        for patch in patches:
+            patch.stop()
+
+def report(results: list[dict]) -> str:
+    columns = list(results[0])
+    widths  = [max(len(column), 12) for column in columns]
+    def row(values) -> str:
+        return "  ".join(
+            (f"{value:.2f}" if isinstance(value, float) else str(value)).rjust(width)
+            for value, width in zip(values, widths))
+    return "\n".join([row(columns)] + [row(result.values()) for result in results])
+
+def main():
+    p = argparse.ArgumentParser(
+        description     = __doc__,
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--repeat',
+        type    = int,
+        default = 3,
+        help    = 'The amount of times every benchmark is run. The default is `3`.')
+    sub_p = p.add_subparsers(dest = 'mode', required = True)
+    real_p = sub_p.add_parser('real', help = 'Benchmark h2kf with ImageMagick over the synthetic corpus.')
+    real_p.add_argument('corpus', help = 'The directory of the corpus. It is generated if needed.')
+    real_p.add_argument('--jobs',
+        type    = int,
+        default = 1,
+        help    = 'The amount of worker processes. Latencies are only measured when it is `1`.')
+    real_p.add_argument('--backend',
+        choices = BACKEND_NAMES,
+        default = BACKEND_NAMES[0],
+        help    = f'The backend doing the pixel work. The default is `{BACKEND_NAMES[0]}`.')
+    mock_p = sub_p.add_parser('mock', help = 'Benchmark the overhead of h2kf with ImageMagick mocked.')
+    mock_p.add_argument('--images',
+        type    = int,
+        default = 1000,
+        help    = 'The amount of images of every run. The default is `1000`.')
+    args = p.parse_args()
+    logging.basicConfig(level = logging.CRITICAL)
+    if args.mode == 'real':
+        results = bench_real(args.corpus, args.repeat, args.jobs, args.backend)
+    else:
+        results = bench_mock(args.images, args.repeat)
+    print(report(results))
+
+if __name__ == "__main__":
+    main()
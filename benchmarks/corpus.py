@@ -0,0 +1,99 @@
+'''
+Generator of the synthetic image corpus used by the benchmarks.
+
+The corpus is laid out as `<directory>/<format>-<dpi>dpi/<megapixels>mp.<format>`, one directory per
+format and resolution so that every directory can be processed by a single call to `process_images`.
+The images are plasma fractals generated from a fixed seed, hence the corpus is the same on every machine
+running the same version of ImageMagick.
+'''
+import os
+import math
+import logging
+import argparse
+
+from wand.image import Image
+import wand.version as wver
+
+FORMATS: tuple[str, ...]      = ("PNG", "JPG", "HEIC")
+RESOLUTIONS: tuple[int, ...]  = (72, 96, 300)
+MEGAPIXELS: tuple[int, ...]   = (1, 12, 24, 48)
+ASPECT_RATIO: float           = 4 / 3 # as most phone cameras.
+SEED: int                     = 2022
+
+def image_size(megapixels: int) -> tuple[int, int]:
+    '''
+    Get the size in pixels of a 4:3 image of `megapixels` megapixels.
+    '''
+    height = round(math.sqrt(megapixels * 1000000 / ASPECT_RATIO))
+    return round(height * ASPECT_RATIO), height
+
+def group_directory(directory: str, output_format: str, resolution: int) -> str:
+    return os.path.join(directory, f"{output_format.lower()}-{resolution}dpi")
+
+def generate_corpus(
+    directory: str,
+    formats: tuple[str, ...]     = FORMATS,
+    resolutions: tuple[int, ...] = RESOLUTIONS,
+    megapixels: tuple[int, ...]  = MEGAPIXELS,
+    seed: int                    = SEED) -> list[str]:
+    '''
+    Generate the corpus in `directory`. Images which already exist are kept as they are, so that the corpus
+    is only generated once. Formats not supported by ImageMagick on this system (usually HEIC) are skipped.
+
+    :param: directory   (str)             -- The directory to generate the corpus in.
+    :param: formats     (tuple[str, ...]) -- The formats of the images.
+    :param: resolutions (tuple[int, ...]) -- The resolutions of the images, in DPI.
+    :param: megapixels  (tuple[int, ...]) -- The sizes of the images, in megapixels.
+    :param: seed        (int)             -- The seed of the plasma fractals.
+
+    :return: The directories of the corpus, one per format and resolution.
+    '''
+    logger = logging.getLogger(__name__)
+    directories: list[str] = []
+    for output_format in formats:
+        if not wver.formats(output_format):
+            logger.warning(f"Skipping format {output_format} as it is not supported by the system.")
+            continue
+        for resolution in resolutions:
+            group = group_directory(directory, output_format, resolution)
+            os.makedirs(group, exist_ok = True)
+            directories.append(group)
+            for size in megapixels:
+                path = os.path.join(group, f"{size}mp.{output_format.lower()}")
+                if os.path.exists(path):
+                    continue
+                logger.info(f"Generating {path}")
+                with Image() as image:
+                    # Every image gets its own seed so that images of the same size differ across groups.
+                    image.seed = seed + size * 1000 + resolution
+                    image.pseudo(*image_size(size), pseudo = "plasma:")
+                    image.units      = "pixelsperinch"
+                    image.resolution = (resolution, resolution)
+                    image.format     = output_format
+                    image.save(filename = path)
+    return directories
+
+def main():
+    p = argparse.ArgumentParser(description = __doc__)
+    p.add_argument('directory', help = 'The directory to generate the corpus in.')
+    p.add_argument('--formats',
+        nargs   = '+',
+        default = FORMATS,
+        type    = str.upper,
+        help    = 'The formats of the images.')
+    p.add_argument('--resolutions',
+        nargs   = '+',
+        default = RESOLUTIONS,
+        type    = int,
+        help    = 'The resolutions of the images, in DPI.')
+    p.add_argument('--megapixels',
+        nargs   = '+',
+        default = MEGAPIXELS,
+        type    = int,
+        help    = 'The sizes of the images, in megapixels.')
+    args = p.parse_args()
+    logging.basicConfig(level = logging.INFO, format = "%(message)s")
+    generate_corpus(args.directory, tuple(args.formats), tuple(args.resolutions), tuple(args.megapixels))
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,9 @@ setup(
     },
     packages         = ["h2kf"],
     install_requires = ["wand==0.6.9"],
+    extras_require   = {
+        "vips": ["pyvips"]
+    },
     entry_points     = {
         "console_scripts": ['h2kf = h2kf.cli:main']
     },
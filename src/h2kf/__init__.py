@@ -1,2 +1,48 @@
-from .image import *
-from .constants import *
\ No newline at end of file
+import importlib
+
+from . import constants as _constants
+from .constants import *
+
+# The modules are only imported once one of their names is used, so that e.g. `h2kf --help` does not load
+# ImageMagick.
+_MODULES: tuple[str, ...] = ("image", "manifest", "profile", "watch", "capabilities", "archive", "preview", "dedup", "batch", "backend")
+
+# The module of every name of the public interface.
+_EXPORTS: dict[str, str] = {
+    "ProcessException":  "image",
+    "ImageProcessor":    "image",
+    "Rendition":         "image",
+    "MemoryBudget":      "image",
+    "format_image":      "image",
+    "process_images":    "image",
+    "Manifest":          "manifest",
+    "Profile":           "profile",
+    "Stopwatch":         "profile",
+    "watch_images":      "watch",
+    "CapabilityCache":   "capabilities",
+    "supports_font":     "capabilities",
+    "supports_format":   "capabilities",
+    "Archive":           "archive",
+    "find_preview":      "preview",
+    "find_duplicates":   "dedup",
+    "BatchJob":          "batch",
+    "BatchResult":       "batch",
+    "read_batch":        "batch",
+    "process_batch":     "batch",
+    "summarize":         "batch",
+    "Backend":           "backend",
+    "WandBackend":       "backend",
+    "VipsBackend":       "backend",
+    "get_backend":       "backend"
+}
+
+__all__: list[str] = [name for name in vars(_constants) if not name.startswith("_")] + list(_EXPORTS)
+
+def __getattr__(name: str):
+    if name in _MODULES:
+        return importlib.import_module(f".{name}", __name__)
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
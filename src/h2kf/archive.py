@@ -0,0 +1,71 @@
+'''
+Archives the outputs of `process_images` can be streamed into, e.g. for the submission of a file.
+'''
+import io
+import os
+import time
+import tarfile
+import zipfile
+import threading
+
+from typing import Union
+
+from .constants import ARCHIVE_FORMATS
+
+class Archive:
+    '''
+    An archive the outputs are written to as they are converted, instead of being written to a directory
+    and archived afterwards. Entries are written as they are added, hence only the entry being written is
+    held in memory whatever the size of the archive.
+
+    The archive is written to a hidden temporary file which replaces `path` once the archive is closed, so
+    that an interrupted run never leaves a truncated archive behind. An archive must only be written to
+    from one thread.
+    '''
+    def __init__(self, path: str, archive_format: str = "zip"):
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Archive format {archive_format} is not supported. Use one of {', '.join(ARCHIVE_FORMATS)}.")
+        directory, name = os.path.split(path)
+        self.path: str                                    = path
+        self.archive_format: str                          = archive_format
+        self._temporary: str                              = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        self._file: Union[zipfile.ZipFile, tarfile.TarFile]
+        if archive_format == "zip":
+            # The outputs are already compressed by their format, hence they are stored as is.
+            self._file = zipfile.ZipFile(self._temporary, "w", compression = zipfile.ZIP_STORED)
+        else:
+            self._file = tarfile.open(self._temporary, ARCHIVE_FORMATS[archive_format])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close(discard = type is not None)
+
+    def add(self, name: str, data: bytes) -> None:
+        '''
+        Write `data` as the entry `name` of the archive.
+        '''
+        if isinstance(self._file, zipfile.ZipFile):
+            self._file.writestr(name, data)
+        else:
+            info       = tarfile.TarInfo(name)
+            info.size  = len(data)
+            info.mtime = int(time.time())
+            self._file.addfile(info, io.BytesIO(data))
+
+    def close(self, discard: bool = False) -> None:
+        '''
+        Finish writing the archive and move it to its path, or remove it when `discard` is set.
+        '''
+        try:
+            self._file.close()
+        except BaseException:
+            discard = True
+            raise
+        finally:
+            if discard:
+                if os.path.exists(self._temporary):
+                    os.remove(self._temporary)
+            else:
+                os.replace(self._temporary, self.path)
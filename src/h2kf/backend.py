@@ -0,0 +1,480 @@
+'''
+Imaging backends doing the pixel work of the conversions: reading headers, decoding, resampling, stamping and
+encoding images. `wand`, i.e. ImageMagick, is the default backend. The `vips` backend streams images through
+libvips, which is usually faster and holds far less memory when downscaling.
+'''
+import os
+import math
+import logging
+import functools
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from wand.image import Image
+from wand.drawing import Drawing
+from wand.color import Color
+
+from typing import Union, NamedTuple
+
+from .capabilities import supports_font, supports_format
+
+DEFAULT_RESOLUTION: float               = 72.0      # resolution assumed when unset
+STAMP_CACHE_SIZE: int                   = 64        # amount of rendered stamps kept per process
+EXIF_DATE_FORMAT: str                   = "%Y:%m:%d %H:%M:%S"
+REDUCED_DECODE_FACTORS: tuple[int, ...] = (8, 4, 2) # factors JPEG images can be decoded at reduced size by
+MM_PER_INCH: float                      = 25.4
+RESOLUTION_DIGITS: int                  = 1         # decimals resolutions are rounded to, see `_round_resolution`
+BASELINE_REFERENCE: str                 = "H"       # a letter sitting on the baseline, see `VipsBackend.stamp`
+
+class _Header(NamedTuple):
+    '''
+    The properties of an image read from its header, without decoding its pixels.
+    '''
+    width: int
+    height: int
+    resolution: tuple[float, float]
+    captured: Union[datetime, None] # the capture date from EXIF, if any.
+    channels: int = 3               # the amount of channels of the pixels, alpha included.
+
+def _parse_exif_date(value: Union[str, None]) -> Union[datetime, None]:
+    '''
+    Parse an EXIF date, ignoring it when malformed.
+    '''
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value.strip()[:19], EXIF_DATE_FORMAT)
+    except ValueError:
+        logging.getLogger(__name__).debug(f"Ignoring malformed EXIF date {value!r}")
+        return None
+
+def _round_resolution(resolution: tuple[float, float]) -> tuple[float, float]:
+    '''
+    Round a resolution in DPI to `RESOLUTION_DIGITS` decimals. Formats such as PNG store resolutions in whole
+    pixels per metre, hence e.g. 72 DPI is read back as 72.009 DPI.
+    '''
+    return tuple(round(res, RESOLUTION_DIGITS) for res in resolution)
+
+def _wand_resolution(image: Image) -> tuple[float, float]:
+    '''
+    The resolution of `image` in DPI. ImageMagick holds it in the units of the source, e.g. pixels per
+    centimetre for PNG images, and resolutions without units are taken as DPI.
+    '''
+    factor = MM_PER_INCH / 10 if image.units == "pixelspercentimeter" else 1
+    x, y   = image.resolution
+    return _round_resolution((x * factor, y * factor))
+
+class Backend:
+    '''
+    The pixel operations a conversion is made of. The images are opaque to the callers, which only hand them
+    back to the backend which decoded them. An operation may modify the image in place or return a new one,
+    hence callers always carry on with the image it returns.
+
+    A backend holds no state specific to an image, hence it can be used from multiple threads at once.
+
+    :param: source (dict) -- Either `{"filename": ...}` or `{"blob": ...}`, for every method reading an image.
+    '''
+    name: str = None
+
+    def supports_font(self, font: str) -> bool:
+        raise NotImplementedError
+
+    def supports_format(self, output_format: str) -> bool:
+        raise NotImplementedError
+
+    def read_header(self, source: dict) -> _Header:
+        '''
+        Read the size, resolution and capture date of the image from `source` without decoding its pixels.
+        '''
+        raise NotImplementedError
+
+    def decode(self, source: dict, size_hint: tuple[int, int] = None):
+        '''
+        Decode the image from `source`. When `size_hint` is set, JPEG images are decoded at 1/2, 1/4 or 1/8
+        of their size as long as they still cover it, which saves most of the decoding time and memory.
+
+        :return: The decoded image. The caller is responsible for closing it.
+        '''
+        raise NotImplementedError
+
+    def close(self, image) -> None:
+        pass
+
+    def size(self, image) -> tuple[int, int]:
+        raise NotImplementedError
+
+    def resolution(self, image) -> tuple[float, float]:
+        '''
+        The resolution of `image` in DPI, whatever the units of its format, `(0.0, 0.0)` when unset.
+        '''
+        raise NotImplementedError
+
+    def resample(self, image, resolution: tuple[float, float], output_resolution: tuple[float, float]):
+        '''
+        Resample `image`, of the given `resolution`, to `output_resolution`, keeping its physical size. Both
+        resolutions are in DPI.
+        '''
+        raise NotImplementedError
+
+    def stamp(self,
+        image,
+        text: str,
+        font: str,
+        stamp_size: float,
+        stamp_color: str,
+        stamp_border_color: str,
+        stamp_border_width: int,
+        offset: int):
+        '''
+        Stamp `text` in the bottom left corner of `image`, its baseline `offset` pixels from the bottom and its
+        origin `offset` pixels from the left. See `process_images` for the other parameters.
+        '''
+        raise NotImplementedError
+
+    def hold(self, image):
+        '''
+        Make `image` ready to be read several times, e.g. encoded again or copied.
+        '''
+        return image
+
+    def clone(self, image):
+        '''
+        Copy `image`, so that the copy can be resampled and stamped without modifying `image`. The caller is
+        responsible for closing the copy.
+        '''
+        raise NotImplementedError
+
+    def encode(self,
+        image,
+        output_format: str,
+        quality: int      = None,
+        progressive: bool = False,
+        strip: bool       = False) -> bytes:
+        '''
+        Encode `image` in `output_format`.
+
+        :param: quality     (int)  -- The quality of lossy formats, the default of the encoder when `None`.
+        :param: progressive (bool) -- Whether to encode JPEG images as progressive with optimized coding.
+        :param: strip       (bool) -- Whether to leave out the metadata and profiles of the source.
+        '''
+        raise NotImplementedError
+
+class _Stamp(NamedTuple):
+    '''
+    A stamp rendered as a transparent overlay. `left` and `baseline` are the position of the origin of the text
+    in the overlay.
+    '''
+    overlay: Image
+    left: int
+    baseline: int
+
+class StampCache:
+    '''
+    Least recently used cache of the stamps rendered as transparent overlays. In a batch, the stamp text and its
+    settings are nearly always the same, hence the text only needs to be rasterized once and can then be
+    composited onto every image.
+
+    The cache is safe to use from multiple threads. Every process has its own cache. Evicted overlays are
+    not closed but released, so that they are only destroyed once no conversion uses them anymore.
+    '''
+    def __init__(self, maxsize: int = STAMP_CACHE_SIZE):
+        self.maxsize: int                             = maxsize
+        self._stamps: OrderedDict[tuple, _Stamp]      = OrderedDict()
+        self._lock: threading.Lock                    = threading.Lock()
+
+    def get(self,
+        text: str,
+        font: str,
+        stamp_size: float,
+        stamp_color: str,
+        stamp_border_color: str,
+        stamp_border_width: int,
+        image: Image) -> _Stamp:
+        '''
+        Get the stamp of `text` with the given settings, rendering it if it is not cached.
+
+        :param: image (Image) -- An image used to measure the text when rendering it. It is not modified.
+
+        See `process_images` for the other parameters.
+        '''
+        key = (text, font, stamp_size, stamp_color, stamp_border_color, stamp_border_width)
+        with self._lock:
+            stamp = self._stamps.get(key)
+            if stamp:
+                self._stamps.move_to_end(key)
+                return stamp
+            stamp = _render_stamp(*key, image)
+            self._stamps[key] = stamp
+            if len(self._stamps) > self.maxsize:
+                self._stamps.popitem(last = False)
+            return stamp
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stamps.clear()
+
+_stamp_cache: StampCache = StampCache()
+
+def _render_stamp(
+    text: str,
+    font: str,
+    stamp_size: float,
+    stamp_color: str,
+    stamp_border_color: str,
+    stamp_border_width: int,
+    image: Image) -> _Stamp:
+    '''
+    Render `text` on a transparent overlay just large enough to hold it.
+
+    :param: image (Image) -- An image used to measure the text. It is not modified.
+
+    See `process_images` for the other parameters.
+    '''
+    with Drawing() as draw:
+        draw.font = font
+        draw.fill_color = Color(stamp_color)
+        draw.stroke_color = Color(stamp_border_color)
+        draw.stroke_width = stamp_border_width
+        draw.font_size  = stamp_size
+        metrics = draw.get_font_metrics(image, text)
+        # Pad by the border width so that the border of the glyphs is not clipped.
+        pad      = math.ceil(stamp_border_width)
+        baseline = math.ceil(metrics.ascender) + pad
+        overlay  = Image(
+            width      = math.ceil(metrics.text_width) + 2 * pad,
+            height     = baseline + math.ceil(-metrics.descender) + pad,
+            background = Color("transparent"))
+        try:
+            draw.text(pad, baseline, text)
+            draw(overlay)
+        except BaseException:
+            overlay.close()
+            raise
+    return _Stamp(overlay, pad, baseline)
+
+class WandBackend(Backend):
+    '''
+    Backend doing the pixel work with ImageMagick, through `wand`. Every operation works on the decoded image
+    itself, so that only one pixel buffer is held at a time.
+    '''
+    name: str = "wand"
+
+    def supports_font(self, font: str) -> bool:
+        return supports_font(font)
+
+    def supports_format(self, output_format: str) -> bool:
+        return supports_format(output_format)
+
+    def read_header(self, source: dict) -> _Header:
+        with Image.ping(**source) as image:
+            captured = _parse_exif_date(image.metadata.get("exif:DateTimeOriginal") or image.metadata.get("exif:DateTime"))
+            channels = {"gray": 1, "cmyk": 4}.get(image.colorspace, 3) + bool(image.alpha_channel)
+            return _Header(image.width, image.height, _wand_resolution(image), captured, channels)
+
+    def decode(self, source: dict, size_hint: tuple[int, int] = None) -> Image:
+        if not size_hint:
+            return Image(**source)
+        image = Image()
+        try:
+            image.options['jpeg:size'] = '%ix%i' % size_hint
+            image.read(**source)
+        except BaseException:
+            image.close()
+            raise
+        return image
+
+    def close(self, image: Image) -> None:
+        image.close()
+
+    def clone(self, image: Image) -> Image:
+        return image.clone()
+
+    def size(self, image: Image) -> tuple[int, int]:
+        return image.width, image.height
+
+    def resolution(self, image: Image) -> tuple[float, float]:
+        return _wand_resolution(image)
+
+    def resample(self, image: Image, resolution: tuple[float, float], output_resolution: tuple[float, float]) -> Image:
+        # ImageMagick resamples in the units of the image, hence they are set to DPI along with the resolution.
+        image.units      = "pixelsperinch"
+        image.resolution = resolution
+        image.resample(*output_resolution)
+        return image
+
+    def stamp(self,
+        image: Image,
+        text: str,
+        font: str,
+        stamp_size: float,
+        stamp_color: str,
+        stamp_border_color: str,
+        stamp_border_width: int,
+        offset: int) -> Image:
+        stamp = _stamp_cache.get(text, font, stamp_size, stamp_color, stamp_border_color, stamp_border_width, image)
+        image.composite(stamp.overlay, left = offset - stamp.left, top = image.height - offset - stamp.baseline)
+        return image
+
+    def encode(self,
+        image: Image,
+        output_format: str,
+        quality: int      = None,
+        progressive: bool = False,
+        strip: bool       = False) -> bytes:
+        image.format = output_format
+        if progressive and output_format.upper() in ("JPG", "JPEG"):
+            image.interlace_scheme = 'plane'
+            image.options['jpeg:optimize-coding'] = 'true'
+        if strip:
+            image.strip()
+        if quality:
+            image.compression_quality = quality
+        return image.make_blob()
+
+class VipsBackend(Backend):
+    '''
+    Backend doing the pixel work with libvips, through `pyvips`. Images are decoded on demand as they are
+    resampled and encoded, hence only a few lines of pixels of the source are held in memory at a time.
+    `pyvips` is an optional dependency, only imported once the backend is used.
+
+    The stamp is rendered by Pango rather than ImageMagick, hence its glyphs may differ slightly; its size,
+    colors, border and position are the same.
+    '''
+    name: str = "vips"
+    SAVERS: dict[str, str] = {"JPG": ".jpg", "JPEG": ".jpg", "PNG": ".png", "HEIC": ".heic"}
+    # The fields of the metadata and profiles of the source, left out when stripping.
+    STRIPPED_FIELDS: tuple[str, ...] = ("exif-", "xmp-data", "iptc-data", "icc-profile-data")
+
+    def __init__(self):
+        try:
+            import pyvips
+        except (ImportError, OSError) as e: # OSError: libvips itself is missing.
+            raise ValueError(f"The `vips` backend requires pyvips and libvips: {e}")
+        self._pyvips = pyvips
+
+    def _load(self, source: dict, **options):
+        if "filename" in source:
+            return self._pyvips.Image.new_from_file(source["filename"], access = "sequential", **options)
+        return self._pyvips.Image.new_from_buffer(source["blob"], "", access = "sequential", **options)
+
+    def supports_font(self, font: str) -> bool:
+        return True # fontconfig substitutes the fonts it does not have.
+
+    def supports_format(self, output_format: str) -> bool:
+        suffix = self.SAVERS.get(output_format.upper())
+        if not suffix:
+            return False
+        try:
+            self._pyvips.Image.black(1, 1).write_to_buffer(suffix)
+        except self._pyvips.Error:
+            return False
+        return True
+
+    def read_header(self, source: dict) -> _Header:
+        image    = self._load(source) # only the header is read until the pixels are needed.
+        captured = None
+        for field in ("exif-ifd2-DateTimeOriginal", "exif-ifd0-DateTime"):
+            if image.get_typeof(field):
+                captured = _parse_exif_date(image.get(field))
+                break
+        return _Header(image.width, image.height, self.resolution(image), captured, image.bands)
+
+    def decode(self, source: dict, size_hint: tuple[int, int] = None):
+        image = self._load(source)
+        if size_hint:
+            shrink = next((factor for factor in REDUCED_DECODE_FACTORS
+                if image.width // factor >= size_hint[0] and image.height // factor >= size_hint[1]), 1)
+            if shrink > 1:
+                image = self._load(source, shrink = shrink)
+        if image.interpretation != "srgb":
+            image = image.colourspace("srgb")
+        return image
+
+    def size(self, image) -> tuple[int, int]:
+        return image.width, image.height
+
+    def resolution(self, image) -> tuple[float, float]:
+        # libvips holds resolutions in pixels per millimetre. Unset resolutions are 1 pixel per millimetre.
+        resolution = _round_resolution((image.xres * MM_PER_INCH, image.yres * MM_PER_INCH))
+        return tuple(0.0 if res == MM_PER_INCH else res for res in resolution)
+
+    def resample(self, image, resolution: tuple[float, float], output_resolution: tuple[float, float]):
+        xscale, yscale = (out / (res or DEFAULT_RESOLUTION) for res, out in zip(resolution, output_resolution))
+        image = image.resize(xscale, vscale = yscale)
+        return image.copy(xres = output_resolution[0] / MM_PER_INCH, yres = output_resolution[1] / MM_PER_INCH)
+
+    def stamp(self,
+        image,
+        text: str,
+        font: str,
+        stamp_size: float,
+        stamp_color: str,
+        stamp_border_color: str,
+        stamp_border_width: int,
+        offset: int):
+        pyvips = self._pyvips
+        if os.path.isfile(font):
+            options = {"fontfile": font, "font": f"{os.path.splitext(os.path.basename(font))[0]} {stamp_size}", "dpi": 72}
+        else:
+            options = {"font": f"{font} {stamp_size}", "dpi": 72}
+        mask = pyvips.Image.text(text, **options)
+        # The mask only holds the ink of the text, `xoffset` and `yoffset` from the origin of its line. The
+        # baseline is the bottom of the ink of a letter sitting on it, so that it is placed like ImageMagick
+        # places it whether the text has descenders or not.
+        reference = pyvips.Image.text(BASELINE_REFERENCE, **options)
+        baseline  = reference.yoffset + reference.height - mask.yoffset # from the top of the mask.
+        left      = mask.xoffset
+        # The border is the text dilated by its width.
+        pad  = math.ceil(stamp_border_width)
+        mask = mask.embed(pad, pad, mask.width + 2 * pad, mask.height + 2 * pad)
+        size = 2 * pad + 1
+        def layer(color: str, alpha):
+            color = Color(color)
+            rgb   = mask.new_from_image([color.red_int8, color.green_int8, color.blue_int8])
+            return rgb.bandjoin(alpha).copy(interpretation = "srgb")
+        overlay = layer(stamp_color, mask)
+        if pad:
+            overlay = layer(stamp_border_color, mask.rank(size, size, size * size - 1)).composite2(overlay, "over")
+        bands = image.bands
+        image = image.composite2(overlay, "over", x = offset + left - pad, y = image.height - offset - baseline - pad)
+        return image[:bands] # compositing adds an alpha channel to images without one.
+
+    def hold(self, image):
+        return image.copy_memory() # the source is read sequentially, hence only once.
+
+    def clone(self, image):
+        return image # images are immutable, every operation returns a new image.
+
+    def encode(self,
+        image,
+        output_format: str,
+        quality: int      = None,
+        progressive: bool = False,
+        strip: bool       = False) -> bytes:
+        suffix  = self.SAVERS[output_format.upper()]
+        options = {}
+        if strip:
+            # The `strip` option of libvips also resets the resolution to 72 DPI, hence the fields are removed.
+            image = image.copy()
+            for field in image.get_fields():
+                if field.startswith(self.STRIPPED_FIELDS):
+                    image.remove(field)
+        if quality and suffix != ".png":
+            options["Q"] = quality
+        if progressive and suffix == ".jpg":
+            options.update(interlace = True, optimize_coding = True)
+        return image.write_to_buffer(suffix, **options)
+
+BACKENDS: dict[str, type] = {backend.name: backend for backend in (WandBackend, VipsBackend)} # in the order of `BACKEND_NAMES`.
+
+@functools.lru_cache(maxsize = None)
+def get_backend(name: str = "wand") -> Backend:
+    '''
+    Get the backend `name`, one of `BACKENDS`. Backends are created once per process.
+
+    :raises: ValueError -- If the backend does not exist or its dependencies are not installed.
+    '''
+    if name not in BACKENDS:
+        raise ValueError(f"Backend {name} does not exist. Use one of {', '.join(BACKENDS)}.")
+    return BACKENDS[name]()
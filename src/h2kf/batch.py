@@ -0,0 +1,149 @@
+'''
+Conversion of the images of many files in a single run, as described by a batch manifest.
+'''
+import os
+import csv
+import json
+import inspect
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from typing import Union, NamedTuple
+
+from .image import ImageProcessor, MemoryBudget, ProcessException, process_images, _process_pool, _check_limits
+from .constants import TIMESTAMP_SOURCES
+
+BATCH_FIELDS: tuple[str, ...] = ("src_directory", "out_directory", "file_id", "date")
+
+class BatchJob(NamedTuple):
+    '''
+    A file of a batch, i.e. a row of a batch manifest.
+    '''
+    src_directory: str
+    out_directory: str
+    file_id: str
+    date: Union[str, None]             # `None` when the timestamps are generated.
+    timestamp_source: Union[str, None] # the metadata the timestamps are generated from, see `process_images`.
+
+class BatchResult(NamedTuple):
+    '''
+    The outcome of a file of a batch.
+    '''
+    job: BatchJob
+    error: Union[Exception, None]  # `ProcessException` when only some images failed.
+    duplicates: dict[str, str]     # see `process_images`.
+
+def read_batch(path: str) -> list[BatchJob]:
+    '''
+    Read the batch manifest at `path`, either a CSV file with a header row or a JSON array of objects. Every row
+    has the fields of `BATCH_FIELDS`. The `date` is either the date to stamp on the images of the file, or one
+    of `TIMESTAMP_SOURCES` to generate the timestamps from the metadata of the images. Relative directories
+    are relative to the directory of the manifest.
+
+    :raises: ValueError -- If the manifest is not valid.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline = "", encoding = "utf-8") as f:
+        if extension == ".csv":
+            rows = list(csv.DictReader(f))
+        elif extension == ".json":
+            rows = json.load(f)
+            if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+                raise ValueError(f"Batch {path} must be an array of objects.")
+        else:
+            raise ValueError(f"Batch {path} must be a CSV or a JSON file.")
+    directory = os.path.dirname(path)
+    batch: list[BatchJob] = []
+    for index, row in enumerate(rows, start = 1):
+        values = {field: str(row.get(field) or "").strip() for field in BATCH_FIELDS}
+        missing = [field for field in BATCH_FIELDS if not values[field]]
+        if missing:
+            raise ValueError(f"Row {index} of batch {path} is missing {', '.join(missing)}.")
+        date = values["date"]
+        generated = date.lower() in TIMESTAMP_SOURCES
+        batch.append(BatchJob(
+            src_directory    = os.path.join(directory, values["src_directory"]),
+            out_directory    = os.path.join(directory, values["out_directory"]),
+            file_id          = values["file_id"],
+            date             = None if generated else date,
+            timestamp_source = date.lower() if generated else None))
+    return batch
+
+def process_batch(
+    batch: list[BatchJob],
+    jobs: int                 = 1,
+    processor: ImageProcessor = None,
+    **kwargs) -> list[BatchResult]:
+    '''
+    Convert the images of every file of `batch`. The configuration is validated and the workers are started
+    once for the whole batch. Several files are converted at once by the same workers, so that the workers
+    are kept busy while the last images of a file are converted. A file which fails does not prevent the
+    other files from being converted.
+
+    :param: batch     (list[BatchJob])  -- The files to convert, see `read_batch`.
+    :param: jobs      (int)             -- The amount of worker processes converting images in parallel.
+    :param: processor (ImageProcessor)  -- A processor to reuse instead of creating one from the settings of
+                                           `kwargs`.
+
+    The `kwargs` are the settings of `ImageProcessor` and the other parameters of `process_images`, which
+    apply to every file. The `memory_budget` is shared by the files converted at once.
+
+    :return: The result of every file, in the order of `batch`.
+    '''
+    if jobs < 1:
+        raise ValueError("`jobs` must be at least 1.")
+    if kwargs.get("incremental"):
+        out_directories = [os.path.realpath(job.out_directory) for job in batch]
+        if len(set(out_directories)) != len(out_directories):
+            raise ValueError("Files converted incrementally must not share an output directory, as they would share its manifest.")
+    _check_limits(kwargs.get("resource_limits"))
+    if kwargs.get("memory_budget") is not None and jobs > 1:
+        kwargs["memory_budget"] = MemoryBudget(kwargs["memory_budget"])
+    settings = {name: kwargs.pop(name) for name in inspect.signature(ImageProcessor).parameters if name in kwargs}
+    processor = processor or ImageProcessor(**settings)
+    logger = logging.getLogger(__name__)
+    pool: ProcessPoolExecutor = None
+
+    def run(job: BatchJob) -> BatchResult:
+        logger.info(f"Converting the images of file {job.file_id} from {job.src_directory}")
+        try:
+            duplicates = process_images(
+                job.src_directory,
+                job.out_directory,
+                job.file_id,
+                date               = job.date,
+                generate_timestamp = job.date is None,
+                timestamp_source   = job.timestamp_source or TIMESTAMP_SOURCES[0],
+                jobs               = jobs,
+                processor          = processor,
+                pool               = pool,
+                **kwargs)
+        except ProcessException as e:
+            return BatchResult(job, e, e.duplicates)
+        except Exception as e:
+            logger.error(f"Failed to convert the images of file {job.file_id}: {e}")
+            return BatchResult(job, e, {})
+        return BatchResult(job, None, duplicates)
+
+    if jobs == 1:
+        return [run(job) for job in batch]
+    with _process_pool(jobs, processor, kwargs.get("resource_limits")) as pool:
+        with ThreadPoolExecutor(max_workers = jobs, thread_name_prefix = "h2kf-batch") as files:
+            return list(files.map(run, batch))
+
+def summarize(results: list[BatchResult]) -> str:
+    '''
+    Summarize the outcome of every file of a batch, followed by the amount of files which failed.
+    '''
+    lines: list[str] = []
+    for result in results:
+        job = result.job
+        if result.error is None:
+            lines.append(f"ok      {job.file_id} ({job.src_directory})")
+        else:
+            lines.append(f"failed  {job.file_id} ({job.src_directory}): {result.error}")
+        for duplicate, original in result.duplicates.items():
+            lines.append(f"        skipped {duplicate} as it is a duplicate of {original}")
+    failed = sum(result.error is not None for result in results)
+    lines.append(f"{len(results) - failed} of {len(results)} files converted, {failed} failed")
+    return "\n".join(lines)
@@ -0,0 +1,100 @@
+'''
+Capabilities of the ImageMagick installation, cached on disk across runs.
+'''
+import os
+import json
+import logging
+import threading
+
+import wand.version as wver
+
+CACHE_PATH: str = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "h2kf",
+    "capabilities.json")
+
+class CapabilityCache:
+    '''
+    Results of the queries of the fonts and formats supported by ImageMagick. Querying ImageMagick loads its
+    font and format configurations, which is slow compared to a short run, hence the results are kept in a
+    JSON file of the form:
+
+        {"version": ..., "fonts": {"Arial": true, ...}, "formats": {"JPG": true, ...}}
+
+    The results only hold for the version of ImageMagick which produced them, hence the file is discarded
+    when the version changes. Delete the file after installing fonts or delegates without changing the version.
+
+    The cache is safe to use from multiple threads. Failing to read or write the file only disables the cache.
+    '''
+    def __init__(self, path: str = None):
+        self.path: str              = path or CACHE_PATH
+        self._entries: dict         = None
+        self._lock: threading.Lock  = threading.Lock()
+
+    def supports_font(self, font: str) -> bool:
+        return self._query("fonts", font, wver.fonts)
+
+    def supports_format(self, output_format: str) -> bool:
+        return self._query("formats", output_format.upper(), wver.formats)
+
+    def clear(self) -> None:
+        '''
+        Forget the results loaded in memory. The file is read again on the next query.
+        '''
+        with self._lock:
+            self._entries = None
+
+    def _query(self, kind: str, name: str, query) -> bool:
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            results: dict[str, bool] = self._entries[kind]
+            if name not in results:
+                results[name] = bool(query(name))
+                self._save()
+            return results[name]
+
+    def _load(self) -> dict:
+        logger = logging.getLogger(__name__)
+        empty = {"version": wver.MAGICK_VERSION, "fonts": {}, "formats": {}}
+        try:
+            with open(self.path, encoding = "utf-8") as f:
+                entries: dict = json.load(f)
+        except FileNotFoundError:
+            return empty
+        except (OSError, ValueError) as e:
+            logger.debug(f"Ignoring capability cache {self.path}: {e}")
+            return empty
+        if not isinstance(entries, dict) or entries.get("version") != wver.MAGICK_VERSION:
+            logger.debug(f"Discarding capability cache {self.path} of another version of ImageMagick.")
+            return empty
+        entries.setdefault("fonts", {})
+        entries.setdefault("formats", {})
+        return entries
+
+    def _save(self) -> None:
+        # Written to a temporary file first, as other processes may read the cache at the same time.
+        temporary = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            with open(temporary, "w", encoding = "utf-8") as f:
+                json.dump(self._entries, f)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            logging.getLogger(__name__).debug(f"Could not write capability cache {self.path}: {e}")
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+_capabilities: CapabilityCache = CapabilityCache()
+
+def supports_font(font: str) -> bool:
+    '''
+    Whether `font` is supported by ImageMagick.
+    '''
+    return _capabilities.supports_font(font)
+
+def supports_format(output_format: str) -> bool:
+    '''
+    Whether ImageMagick can write images in `output_format`.
+    '''
+    return _capabilities.supports_format(output_format)
@@ -4,8 +4,7 @@ A formatting tool for photos for submission to h2k.
 import argparse
 import logging
 
-from h2kf.image import process_images
-from h2kf.constants import __version__
+from h2kf.constants import __version__, TIMESTAMP_SOURCES, RESOURCE_LIMITS, BACKEND_NAMES, ARCHIVE_FORMATS
 
 import sys
 
@@ -24,36 +23,96 @@ def main():
         default = 0)
     sub_p = p.add_subparsers(
         help     ='''Application processing subcontexts.
-            Currently can only be `image`.
+            Can be `image`, `watch` or `batch`.
             ''',
         required = True)
-    image_p = sub_p.add_parser('image', help = '''
-        Image processing context.
-    ''')
-    image_p.add_argument('src_directory', help='''
-        The directory the tool should scan to find the images.
-    ''')
-    image_p.add_argument('out_directory', help='''
-        The directory in which the tool should output the formatted images.
-    ''')
-    image_p.add_argument('file_id', help='''
-        The ID of the file to be set as the name for every image. Also stamped into the image
-        next to the date.
-    ''')
+    # Arguments shared by the contexts converting images.
+    settings_p = argparse.ArgumentParser(add_help = False)
     def no_case_str(x: str):
         return x.upper()
-    image_p.add_argument('--output-format',
+    settings_p.add_argument('--output-format',
         choices = ('PNG','JPG','HEIC'),
         type    = no_case_str,
         default = "JPG",
         help    = '''
             The format images should use in output. The default is `JPG`. Can be uppercase or lowercase.
         ''')
-    image_p.add_argument('--output-resolution',
+    settings_p.add_argument('--output-resolution',
         nargs   = 2,
         default = None,
         type    = int)
-    date_g = image_p.add_mutually_exclusive_group(
+    def size_str(x: str) -> int:
+        units = {"K": 1000, "M": 1000000, "G": 1000000000}
+        x = x.strip().upper().removesuffix("B")
+        if x[-1:] in units:
+            return round(float(x[:-1]) * units[x[-1]])
+        return int(x)
+    settings_p.add_argument('--max-size',
+        type    = size_str,
+        metavar = 'SIZE',
+        help    = '''
+            The maximum size of every output, in bytes or with a `K` or `M` suffix, e.g. `500K`. Outputs are then
+            stripped of their metadata and encoded with the highest quality which fits, or at a lower resolution
+            if needed.
+        ''')
+    settings_p.add_argument('--progressive',
+        action = 'store_true',
+        help   = '''
+            Encode JPEG outputs as progressive with optimized coding, which usually makes them smaller.
+        ''')
+    settings_p.add_argument('--use-previews',
+        action = 'store_true',
+        help   = '''
+            Decode the preview embedded in JPEG images instead of the images themselves when it has enough pixels
+            for the output, which is much faster for the photos of most phones.
+        ''')
+    settings_p.add_argument('--backend',
+        choices = BACKEND_NAMES,
+        default = BACKEND_NAMES[0],
+        help    = '''
+            The library doing the pixel work. The default is `wand`, i.e. ImageMagick. `vips` streams the images
+            through libvips, which is usually faster and holds far less memory, and requires pyvips.
+        ''')
+    def limit_str(x: str) -> tuple[str, int]:
+        resource, _, value = x.partition("=")
+        resource = resource.strip().lower()
+        if resource not in RESOURCE_LIMITS:
+            raise argparse.ArgumentTypeError(f"resource must be one of {', '.join(RESOURCE_LIMITS)}")
+        try:
+            return resource, size_str(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid limit {value!r}")
+    settings_p.add_argument('--limit',
+        type    = limit_str,
+        action  = 'append',
+        dest    = 'resource_limits',
+        metavar = 'RESOURCE=VALUE',
+        help    = '''
+            Limit an ImageMagick resource of the conversions, e.g. `memory=2G`. Can be repeated. The resources are
+            `memory`, `map` and `disk` in bytes, `area`, `width` and `height` in pixels, `thread` in threads and
+            `time` in seconds. Once `memory` is reached, ImageMagick holds pixels in memory-mapped files up to `map`, then
+            on `disk`, instead of exhausting the memory.
+        ''')
+    settings_p.add_argument('--jobs',
+        '-j',
+        type    = int,
+        default = 1,
+        help    = '''
+            The amount of worker processes converting images in parallel. The default is `1`.
+        ''')
+    # Arguments of the contexts converting the images of a single file.
+    conversion_p = argparse.ArgumentParser(add_help = False, parents = [settings_p])
+    conversion_p.add_argument('src_directory', help='''
+        The directory the tool should scan to find the images.
+    ''')
+    conversion_p.add_argument('out_directory', help='''
+        The directory in which the tool should output the formatted images.
+    ''')
+    conversion_p.add_argument('file_id', help='''
+        The ID of the file to be set as the name for every image. Also stamped into the image
+        next to the date.
+    ''')
+    date_g = conversion_p.add_mutually_exclusive_group(
         required = True)
     date_g.add_argument('--date', help='''
         The date to print on each image. Will default to the current date if not specified. The application does not
@@ -62,9 +121,160 @@ def main():
     date_g.add_argument('--generate-timestamp',
         help   = "Whether the application should use the file metadata to generate the timestamp.",
         action = "store_true")
+    # Arguments of the contexts converting the images of a directory once.
+    run_p = argparse.ArgumentParser(add_help = False)
+    run_p.add_argument('--incremental',
+        action = 'store_true',
+        help   = '''
+            Only convert the images which are new or changed since the last run, according to the manifest
+            kept in the output directory. Also resumes interrupted runs without renumbering the outputs.
+        ''')
+    run_p.add_argument('--recursive',
+        '-r',
+        action = 'store_true',
+        help   = '''
+            Also process the images in the subdirectories of the source directory.
+        ''')
+    run_p.add_argument('--prefetch',
+        type    = int,
+        default = 4,
+        help    = '''
+            The amount of images read ahead from the disk while converting. The default is `4`. Use `0` to
+            disable reading ahead.
+        ''')
+    run_p.add_argument('--archive',
+        choices = tuple(ARCHIVE_FORMATS),
+        help    = '''
+            Write the outputs to an archive named after the file ID in the output directory, e.g.
+            `out_directory/file_id.zip`, instead of writing them to the output directory. Cannot be used with
+            `--incremental`.
+        ''')
+    run_p.add_argument('--prescan',
+        action = 'store_true',
+        help   = '''
+            Read the headers of every image before converting any. Images which cannot be converted are rejected
+            without being decoded, and the largest images are converted first so that the workers finish together.
+        ''')
+    run_p.add_argument('--memory-budget',
+        type    = size_str,
+        metavar = 'SIZE',
+        help    = '''
+            The amount of memory the pixels of the images converted at once may hold, in bytes or with a `K`, `M`
+            or `G` suffix, e.g. `4G`. Workers only start an image once its estimated cost fits in the budget,
+            which implies reading the headers as with `--prescan`. Only applies with `--jobs`.
+        ''')
+    def rendition_str(x: str) -> tuple[str, dict]:
+        def resolution_str(x: str) -> tuple[int, int]:
+            width, _, height = x.lower().partition("x")
+            return int(width), int(height)
+        def bool_str(x: str) -> bool:
+            if x.lower() not in ("true", "false"):
+                raise ValueError(x)
+            return x.lower() == "true"
+        types = {
+            "output-format":      no_case_str,
+            "output-resolution":  resolution_str,
+            "max-size":           size_str,
+            "progressive":        bool_str,
+            "font":               str,
+            "offset":             int,
+            "stamp-size":         float,
+            "stamp-color":        str,
+            "stamp-border-color": str,
+            "stamp-border-width": int
+        }
+        directory, _, fields = x.partition(":")
+        settings: dict = {}
+        for field in filter(None, fields.split(",")):
+            name, _, value = field.partition("=")
+            if name not in types:
+                raise argparse.ArgumentTypeError(f"setting must be one of {', '.join(types)}")
+            try:
+                settings[name.replace("-", "_")] = types[name](value)
+            except ValueError:
+                raise argparse.ArgumentTypeError(f"invalid {name} {value!r}")
+        return directory, settings
+    run_p.add_argument('--rendition',
+        type    = rendition_str,
+        action  = 'append',
+        dest    = 'renditions',
+        metavar = 'DIRECTORY[:SETTING=VALUE,...]',
+        help    = '''
+            Also output every image to DIRECTORY, an existing directory relative to the output directory, with the
+            settings of the other outputs except the given ones, e.g. `previews:output-resolution=10x10,max-size=50K`.
+            Can be repeated.
+            Every image is decoded once for all of its outputs. The stamp is scaled to the size of every rendition
+            unless the rendition sets its size, border or offset. The settings are `output-format`,
+            `output-resolution`, `max-size`, `progressive`, `font`, `offset`, `stamp-size`, `stamp-color`,
+            `stamp-border-color` and `stamp-border-width`. Cannot be used with `--incremental` or `--archive`.
+        ''')
+    run_p.add_argument('--dedup',
+        dest   = 'deduplicate',
+        action = 'store_true',
+        help   = '''
+            Skip the images whose content is the same as the one of an image found before them. The skipped
+            images are listed once done.
+        ''')
+    run_p.add_argument('--dedup-threshold',
+        type    = int,
+        metavar = 'BITS',
+        help    = '''
+            Also skip the images which look like an image found before them, i.e. whose perceptual hashes differ
+            by at most BITS of 64 bits, e.g. `5`. Implies `--dedup`.
+        ''')
+    run_p.add_argument('--profile',
+        action = 'store_true',
+        help   = '''
+            Print the total, mean and 95th percentile duration of every stage of the conversion once done.
+        ''')
+    run_p.add_argument('--profile-records',
+        metavar = 'FILE',
+        help    = '''
+            Write the duration of every stage of the conversion of every image to FILE as JSON lines.
+        ''')
+    image_p = sub_p.add_parser('image', parents = [conversion_p, run_p], help = '''
+        Image processing context.
+    ''')
+    image_p.set_defaults(context = 'image')
+    image_p.add_argument('--timestamp-source',
+        choices = TIMESTAMP_SOURCES,
+        default = TIMESTAMP_SOURCES[0],
+        help    = '''
+            The metadata `--generate-timestamp` uses, either the creation time of the files (`ctime`) or the
+            capture date of the images (`exif`), read from their headers. Images without a capture date fall
+            back to `ctime`. The default is `ctime`.
+        ''')
+    watch_p = sub_p.add_parser('watch', parents = [conversion_p], help = '''
+        Watch processing context. Converts the images of the source directory, then keeps converting the images
+        added to it until interrupted.
+    ''')
+    watch_p.set_defaults(context = 'watch')
+    watch_p.add_argument('--poll',
+        action = 'store_true',
+        help   = '''
+            Poll the source directory instead of relying on inotify, e.g. for network mounts. Polling is also
+            used where inotify is not available.
+        ''')
+    watch_p.add_argument('--poll-interval',
+        type    = float,
+        default = 2.0,
+        help    = '''
+            The interval between two listings of the source directory when polling, in seconds. The default is `2`.
+        ''')
+    batch_p = sub_p.add_parser('batch', parents = [settings_p, run_p], help = '''
+        Batch processing context. Converts the images of many files in a single run.
+    ''')
+    batch_p.set_defaults(context = 'batch')
+    batch_p.add_argument('batch', help = '''
+        A CSV file with a header row or a JSON array of objects, with a row per file. Every row has a
+        `src_directory`, an `out_directory`, a `file_id` and a `date`, which is either the date to stamp on the
+        images or `ctime` or `exif` to generate the timestamps from the metadata of the images. Relative
+        directories are relative to the directory of the batch.
+    ''')
     args = p.parse_args(sys.argv[1:])
 
-    logger: logging.Logger = logging.getLogger(__name__)
+    # Configure the logger of the package so that the logs of every module are shown.
+    logger: logging.Logger = logging.getLogger(__package__ or "h2kf")
     match args.verbose:
         case 0:
             logger.setLevel(logging.CRITICAL)
@@ -82,9 +292,57 @@ def main():
     sh.setFormatter(f)
     logger.addHandler(sh)
 
-    del args.verbose
+    context = args.context
+    del args.verbose, args.context
+    args.resource_limits = dict(args.resource_limits) if args.resource_limits else None
+
+    # Imported once the arguments are parsed, as importing them loads ImageMagick.
+    if context == 'watch':
+        from h2kf.watch import watch_images
+        try:
+            watch_images(**vars(args))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    from h2kf.image import process_images, ProcessException, Rendition
+    if args.renditions:
+        args.renditions = [Rendition(*rendition) for rendition in args.renditions]
+    from h2kf.profile import Profile
+    profile = Profile() if args.profile or args.profile_records else None
+    print_profile, profile_records = args.profile, args.profile_records
+    del args.profile, args.profile_records
+
+    if context == 'batch':
+        from h2kf.batch import read_batch, process_batch, summarize
+        batch = read_batch(args.batch)
+        del args.batch
+        try:
+            results = process_batch(batch, profile = profile, **vars(args))
+        finally:
+            if print_profile:
+                print(profile.summary())
+            if profile_records:
+                profile.write_records(profile_records)
+        print(summarize(results))
+        if any(result.error for result in results):
+            sys.exit(1)
+        return
 
-    process_images(**vars(args))
+    duplicates: dict[str, str] = {}
+    try:
+        duplicates = process_images(profile = profile, **vars(args))
+    except ProcessException as e:
+        duplicates = e.duplicates
+        raise
+    finally:
+        # Also report the images converted before a failure.
+        for duplicate, original in duplicates.items():
+            print(f"Skipped {duplicate} as it is a duplicate of {original}")
+        if print_profile:
+            print(profile.summary())
+        if profile_records:
+            profile.write_records(profile_records)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1 +1,13 @@
-__version__ = "0.1.2"
\ No newline at end of file
+__version__ = "0.1.2"
+
+# The choices shared by the command line and the modules converting the images. They are defined here so that
+# the command line can use them without importing ImageMagick.
+TIMESTAMP_SOURCES: tuple[str, ...] = ("ctime", "exif") # metadata the timestamps can be generated from
+RESOURCE_LIMITS: tuple[str, ...]   = ("memory", "map", "disk", "area", "thread", "time", "width", "height") # ImageMagick resources which can be limited
+BACKEND_NAMES: tuple[str, ...]     = ("wand", "vips") # the backends of `BACKENDS`, the default first
+ARCHIVE_FORMATS: dict[str, str]    = {
+    "zip":    "",
+    "tar":    "w",
+    "tar.gz": "w:gz",
+    "tar.xz": "w:xz"
+} # the modes of `tarfile` of the formats of tar archives.
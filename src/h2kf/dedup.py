@@ -0,0 +1,100 @@
+'''
+Detection of the source images which are duplicates of one another, so that they are only converted once.
+'''
+import os
+import hashlib
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from wand.image import Image
+
+from typing import Union
+
+HASH_THREADS: int                 = 8           # amount of images hashed in parallel
+CHUNK_SIZE: int                   = 1024 * 1024 # bytes read at once when hashing the content of images
+HASH_SIZE: tuple[int, int]        = (9, 8)      # size of the images compared by the perceptual hash
+DECODE_SIZE_HINT: tuple[int, int] = (64, 64)    # size JPEG images are decoded at to compute their perceptual hash
+
+def content_hash(path: str) -> bytes:
+    '''
+    Hash the content of the file at `path`.
+    '''
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.digest()
+
+def perceptual_hash(path: str) -> int:
+    '''
+    Compute the difference hash of the image at `path`: the image is reduced to 9x8 grey pixels and every bit
+    of the 64-bit hash tells whether a pixel is brighter than its right neighbour. Images which look alike,
+    e.g. an image and a re-export of it at another size or quality, have hashes differing by few bits.
+    JPEG images are decoded at reduced size as only a few pixels are needed.
+    '''
+    with Image() as image:
+        image.options['jpeg:size'] = '%ix%i' % DECODE_SIZE_HINT
+        image.read(filename = path)
+        image.transform_colorspace('gray')
+        image.resize(*HASH_SIZE)
+        pixels = image.export_pixels(channel_map = 'I', storage = 'char')
+    width, height = HASH_SIZE
+    value = 0
+    for y in range(height):
+        for x in range(width - 1):
+            value = value << 1 | (pixels[y * width + x] > pixels[y * width + x + 1])
+    return value
+
+def find_duplicates(paths: list[str], threshold: int = None, threads: int = HASH_THREADS) -> dict[str, str]:
+    '''
+    Find the images of `paths` which are duplicates of a previous one. Images are duplicates when their content
+    is the same, which is only hashed for the images of the same size. When `threshold` is set, images are also
+    duplicates when their perceptual hashes differ by at most `threshold` bits, see `perceptual_hash`. Images
+    which cannot be read are never duplicates.
+
+    :param: paths     (list[str]) -- The paths of the images, in the order they are converted in.
+    :param: threshold (int)       -- The maximum amount of bits by which the perceptual hashes of duplicates
+                                     differ, from `0` to `64`. Perceptual hashes are not compared when `None`.
+    :param: threads   (int)       -- The amount of images hashed in parallel.
+
+    :return: The path of the image every duplicate is a duplicate of, by the path of the duplicate.
+    '''
+    logger = logging.getLogger(__name__)
+    def attempt(function, path: str) -> Union[bytes, int, None]:
+        try:
+            return function(path)
+        except Exception as e:
+            logger.debug(f"Could not hash image {path}: {e}")
+            return None
+    duplicates: dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers = threads, thread_name_prefix = "h2kf-hash") as pool:
+        sizes: dict[int, list[str]] = defaultdict(list)
+        for path in paths:
+            try:
+                sizes[os.path.getsize(path)].append(path)
+            except OSError:
+                pass
+        for group in sizes.values():
+            if len(group) < 2:
+                continue
+            originals: dict[bytes, str] = {}
+            for path, digest in zip(group, pool.map(lambda path: attempt(content_hash, path), group)):
+                if digest is None:
+                    continue
+                if digest in originals:
+                    duplicates[path] = originals[digest]
+                else:
+                    originals[digest] = path
+        if threshold is not None:
+            remaining = [path for path in paths if path not in duplicates]
+            hashes: list[tuple[str, int]] = [] # of the images which are not duplicates.
+            for path, value in zip(remaining, pool.map(lambda path: attempt(perceptual_hash, path), remaining)):
+                if value is None:
+                    continue
+                original = next((original for original, other in hashes if (value ^ other).bit_count() <= threshold), None)
+                if original:
+                    duplicates[path] = original
+                else:
+                    hashes.append((path, value))
+    return duplicates
@@ -4,20 +4,717 @@ Source code for the h2k-format application.
 import os
 import logging
 import re
+import math
+import functools
+import threading
 from datetime import datetime
+import queue
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 
-from wand.image import Image
-from wand.drawing import Drawing
-from wand.color import Color
-import wand.version as wver
+from wand.resource import limits
 
-from typing import Union
+from typing import Union, NamedTuple, Iterable, Iterator
+
+from .manifest import Manifest
+from .profile import Profile, Stopwatch
+from .backend import Backend, _Header, get_backend, DEFAULT_RESOLUTION
+from .archive import Archive
+from .constants import ARCHIVE_FORMATS, RESOURCE_LIMITS, TIMESTAMP_SOURCES
+from .preview import find_preview
+from .dedup import find_duplicates
+
+REDUCED_DECODE_EXTENSIONS: tuple[str, ...] = (".jpg", ".jpeg") # formats which can be decoded at reduced size
+JPEG_MAGIC: bytes                          = b"\xff\xd8\xff"  # first bytes of JPEG images
+IMAGE_PATTERN: re.Pattern                  = re.compile(r"\.(png|jpg|jpeg|heic)$", re.IGNORECASE)
+SCAN_THREADS: int                          = 8                 # amount of headers read in parallel by the pre-scan
+LOSSY_FORMATS: tuple[str, ...]             = ("JPG", "JPEG", "HEIC") # formats whose size depends on the quality
+QUALITY_RANGE: tuple[int, int]             = (40, 92)          # qualities searched to fit `max_size`
+MAX_ENCODES: int                           = 10                # encodes per image to fit `max_size`
+POOL_START_METHOD: str                     = "spawn"           # how the workers are started, see `_process_pool`
+CHANNEL_BYTES: int                         = 4                 # bytes per channel of the pixels ImageMagick holds in memory (Q16 HDRI)
 
 class ProcessException(Exception):
-    def __init__(self, msg: str):
-        self.msg = msg
+    def __init__(self, msg: str, failures: dict[str, Exception] = None, duplicates: dict[str, str] = None):
+        self.msg        = msg
+        self.failures   = failures or {}
+        self.duplicates = duplicates or {}
         super().__init__(msg)
 
+class _Task(NamedTuple):
+    '''
+    An image to convert, as planned by `process_images`.
+    '''
+    name: str
+    path: str
+    output_path: str
+    date: str
+    number: int
+    stat: os.stat_result    # only set for incremental runs
+    header: _Header = None  # only set when the headers were scanned before converting
+
+class Rendition(NamedTuple):
+    '''
+    An additional output of every image, derived from the image decoded for the main output of `process_images`.
+    '''
+    out_directory: str    # relative to the output directory of the main output.
+    settings: dict = None # the settings of `ImageProcessor` which differ from those of the main output.
+
+def _pixel_cost(header: _Header) -> int:
+    '''
+    Estimate the memory held by the pixels of the image of `header` once decoded, in bytes. ImageMagick holds
+    every channel at its own depth whatever the depth of the source. The estimate is an upper bound for
+    images decoded at reduced size.
+    '''
+    return header.width * header.height * header.channels * CHANNEL_BYTES
+
+class MemoryBudget:
+    '''
+    Admission control of the conversions by the memory their pixels are estimated to hold, see `_pixel_cost`.
+    A conversion is only started once its cost fits in the budget along with the conversions in progress, so
+    that a few large images converted at once do not exhaust the memory. A conversion whose cost exceeds the
+    whole budget is started alone.
+
+    The budget is safe to use from multiple threads, hence it can be shared by several runs converting images
+    with the same workers, see `process_batch`.
+    '''
+    def __init__(self, limit: int):
+        if limit < 1:
+            raise ValueError("The memory budget must be a positive amount of bytes.")
+        self.limit: int                           = limit
+        self.used: int                            = 0
+        self._condition: threading.Condition      = threading.Condition()
+
+    def acquire(self, cost: int) -> None:
+        '''
+        Wait until `cost` bytes fit in the budget, then reserve them.
+        '''
+        with self._condition:
+            self._condition.wait_for(lambda: self.used == 0 or self.used + cost <= self.limit)
+            self.used += cost
+
+    def release(self, cost: int) -> None:
+        '''
+        Release `cost` bytes reserved by `acquire`.
+        '''
+        with self._condition:
+            self.used -= cost
+            self._condition.notify_all()
+
+_worker_processor: "ImageProcessor" = None # processor of the pool worker, see `_worker_init`.
+
+def _check_limits(resource_limits: Union[dict[str, int], None]) -> None:
+    '''
+    Validate the ImageMagick resource limits, see `process_images`.
+    '''
+    for resource, value in (resource_limits or {}).items():
+        if resource not in RESOURCE_LIMITS:
+            raise ValueError(f"Resource {resource} cannot be limited. Use one of {', '.join(RESOURCE_LIMITS)}.")
+        if not isinstance(value, int) or value < 1:
+            raise ValueError(f"The limit of resource {resource} must be a positive integer.")
+
+@contextlib.contextmanager
+def _resource_limits(resource_limits: Union[dict[str, int], None]) -> Iterator[None]:
+    '''
+    Apply the ImageMagick `resource_limits` to this process, and restore the previous limits on exit.
+    '''
+    previous = {resource: limits[resource] for resource in resource_limits or {}}
+    try:
+        limits.update(resource_limits or {})
+        yield
+    finally:
+        limits.update(previous)
+
+def _worker_init(threads: int, processor: "ImageProcessor", resource_limits: dict[str, int] = None) -> None:
+    '''
+    Initializer for the workers of the process pool. Caps the amount of threads ImageMagick
+    may use in the worker so that `jobs` workers do not oversubscribe the CPU.
+
+    :param: threads         (int)            -- The amount of threads ImageMagick may use in this worker.
+    :param: processor       (ImageProcessor) -- The processor converting the images in this worker. It is
+                                                validated by the parent process, not again by the worker.
+    :param: resource_limits (dict[str, int]) -- The ImageMagick resource limits of this worker, see
+                                                `process_images`. A `thread` limit overrides `threads`.
+    '''
+    global _worker_processor
+    limits['thread']  = threads
+    for resource, value in (resource_limits or {}).items():
+        limits[resource] = value
+    _worker_processor = processor
+
+def _process_pool(jobs: int, processor: "ImageProcessor", resource_limits: dict[str, int] = None) -> ProcessPoolExecutor:
+    '''
+    Start a pool of `jobs` workers converting images with `processor`, see `_worker_init`. The cores are split
+    between the workers so that ImageMagick's own threading does not oversubscribe the CPU.
+
+    The workers are spawned rather than forked: validating `processor` may have run libvips in this process,
+    whose threads do not survive a fork, leaving forked workers hanging.
+    '''
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    logging.getLogger(__name__).debug(f"Converting images with {jobs} workers of {threads} thread(s) each.")
+    return ProcessPoolExecutor(
+        max_workers = jobs,
+        initializer = _worker_init,
+        initargs    = (threads, processor, resource_limits),
+        mp_context  = multiprocessing.get_context(POOL_START_METHOD))
+
+def _worker_convert(*args, **kwargs) -> Union[dict, None]:
+    '''
+    Convert a file in a pool worker, see `ImageProcessor.convert_file`.
+    '''
+    return _worker_processor.convert_file(*args, **kwargs)
+
+def _worker_encode(*args, **kwargs) -> tuple[bytes, Union[dict, None]]:
+    '''
+    Convert a file in a pool worker without writing it, see `ImageProcessor.encode_file`.
+    '''
+    return _worker_processor.encode_file(*args, **kwargs)
+
+def _guess_output_settings(
+    resolution: tuple[float, float],
+    height: int) -> tuple[tuple[int, int], float, int, int]:
+    '''
+    Guess the output resolution of an image whose output resolution was not set. Note that this
+    also affects the stamp size, the stamp border width and the offset.
+
+    :param: resolution (tuple[float, float]) -- The resolution of the source image.
+    :param: height     (int)                 -- The height of the source image in pixels.
+
+    :return: (output_resolution, stamp_size, stamp_border_width, offset)
+    '''
+    logger = logging.getLogger(__name__)
+    logger.debug('''Attempting to guess output resolution
+        of image as image resolution was not set. Original
+        image resolution is %ix%i. Note that this also affects
+        stamp_size and `stamp_border_width`''' % tuple(resolution))
+    res = max(resolution)
+    if res <= 72:
+        output_resolution  = (25,25)
+        stamp_border_width = 1
+        offset             = 5
+    elif res <= 102:
+        output_resolution  = (70,70)
+        stamp_border_width = 2
+        offset             = 10
+    elif res <= 500:
+        output_resolution  = (200,200)
+        stamp_border_width = 2
+        offset             = 20
+        logger.info("Image resolution is large. Consider explicitly supplying a different output resolution with `--output-resolution`.")
+    else:
+        raise ValueError("`output_resolution` must be specified for image of a resolution larger than 500 on either dimension.")
+    logger.debug("Applying resolution %ix%i to output." % output_resolution)
+    return output_resolution, 0.03 * height, stamp_border_width, offset
+
+def _output_size(
+    size: tuple[int, int],
+    resolution: tuple[float, float],
+    output_resolution: tuple[int, int]) -> tuple[int, int]:
+    '''
+    Compute the size in pixels of an image of the given `size` and `resolution` once resampled
+    to `output_resolution`.
+    '''
+    return tuple(
+        math.ceil(length * out / (res or DEFAULT_RESOLUTION))
+        for length, res, out in zip(size, resolution, output_resolution))
+
+def _scan_headers(paths: Iterable[str], backend: Backend, threads: int = SCAN_THREADS) -> Iterator[Union[_Header, Exception]]:
+    '''
+    Read the headers of the images at `paths` in parallel, see `Backend.read_header`. The headers are yielded in
+    the order of `paths`. An image whose header cannot be read is yielded with the error instead.
+    '''
+    def scan(path: str) -> Union[_Header, Exception]:
+        try:
+            return backend.read_header({"filename": path})
+        except Exception as e:
+            return e
+    with ThreadPoolExecutor(max_workers = threads, thread_name_prefix = "h2kf-scan") as pool:
+        yield from pool.map(scan, paths)
+
+class ImageProcessor:
+    '''
+    Formats images with a fixed configuration. The font, output format and output resolution are validated
+    once when the processor is created, hence a processor should be reused for every image with the same
+    configuration.
+
+    A processor holds no state specific to an image, hence it can be used from multiple threads at once.
+    It can also be pickled to be sent to other processes, which do not validate it again.
+
+    The automatic output resolution, stamp size, border width and offset are guessed from each image when
+    `output_resolution` is not set. See `process_images` for the parameters.
+    '''
+    def __init__(self,
+        font: str                          = "Arial",
+        output_format: str                 = "JPG",
+        offset: int                        = 5,
+        stamp_size: float                  = None,
+        stamp_color                        = "#FFFFFF",
+        stamp_border_color                 = "#000000",
+        stamp_border_width                 = 1,
+        output_resolution: tuple[int, int] = None,
+        max_size: int                      = None,
+        progressive: bool                  = False,
+        use_previews: bool                 = False,
+        backend: str                       = "wand"):
+        imaging = get_backend(backend)
+        if not imaging.supports_font(font):
+            raise ValueError(f"Font {font} not supported by system.")
+        if not imaging.supports_format(output_format):
+            raise ValueError(f"Image output format {output_format} not supported by system.")
+        if output_resolution:
+            if not type(output_resolution) is tuple and not type(output_resolution) is list:
+                raise TypeError("`output_resolution` must be a tuple of (x-res, y-res).")
+            if len(output_resolution) != 2:
+                raise ValueError("`output_resolution must of a 2-tuple.")
+            output_resolution = tuple(output_resolution)
+        if max_size is not None and max_size < 1:
+            raise ValueError("`max_size` must be a positive amount of bytes.")
+        self.font: str                          = font
+        self.output_format: str                 = output_format
+        self.offset: int                        = offset
+        self.stamp_size: float                  = stamp_size
+        self.stamp_color: str                   = stamp_color
+        self.stamp_border_color: str            = stamp_border_color
+        self.stamp_border_width: int            = stamp_border_width
+        self.output_resolution: tuple[int, int] = output_resolution
+        self.max_size: int                      = max_size
+        self.progressive: bool                  = progressive
+        self.use_previews: bool                 = use_previews
+        self.backend: str                       = backend
+
+    def format_image(self, data: bytes, file_id: str, date: str) -> bytes:
+        '''
+        Format an image held in memory.
+
+        :param: data    (bytes) -- The content of the source image.
+        :param: file_id (str)   -- The ID of the file, stamped next to the date.
+        :param: date    (str)   -- The date to stamp on the image.
+
+        :return: The content of the formatted image, in the output format of the processor.
+        '''
+        return self._convert({"blob": data}, data[:3] == JPEG_MAGIC, file_id, date)
+
+    def convert_file(self,
+        src_path: str,
+        output_path: str,
+        file_id: str,
+        date: str,
+        blob: bytes     = None,
+        profile: bool   = False,
+        header: _Header = None,
+        renditions: list[tuple["ImageProcessor", str]] = None) -> Union[dict, None]:
+        '''
+        Convert the image at `src_path` and save it to `output_path`. This is the unit of work handed
+        to the workers when processing in parallel, hence all arguments must be picklable.
+
+        :param: src_path    (str)   -- The path of the source image.
+        :param: output_path (str)   -- The path where the processed image should be saved.
+        :param: file_id     (str)   -- The ID of the file, stamped next to the date.
+        :param: date        (str)   -- The date to stamp on the image.
+        :param: blob        (bytes) -- The content of the source image if it was already read.
+        :param: profile     (bool)  -- Whether to time the stages of the conversion.
+        :param: header    (_Header) -- The header of the source image if it was already read.
+        :param: renditions  (list)  -- The processor and output path of every other rendition of the image,
+                                       derived from the same decoded image, see `Rendition`.
+
+        :return: The record of the conversion when `profile` is set, see `Profile`.
+        '''
+        renditions = renditions or []
+        processors = [self] + [processor for processor, _ in renditions]
+        outputs, record = self._encode_file(src_path, file_id, date, blob, profile, header, processors)
+        watch = Stopwatch() if profile else None
+        for output, path in zip(outputs, [output_path] + [path for _, path in renditions]):
+            _write_output(path, output)
+        if watch:
+            watch.lap("write")
+            record["output"] = output_path
+            record["stages"].update(watch.stages)
+        return record
+
+    def encode_file(self,
+        src_path: str,
+        file_id: str,
+        date: str,
+        blob: bytes     = None,
+        profile: bool   = False,
+        header: _Header = None) -> tuple[bytes, Union[dict, None]]:
+        '''
+        Convert the image at `src_path` without saving it, see `convert_file`.
+
+        :return: The content of the formatted image, along with the record of the conversion when `profile`
+                 is set. The output of the record is left to the caller.
+        '''
+        outputs, record = self._encode_file(src_path, file_id, date, blob, profile, header, [self])
+        return outputs[0], record
+
+    def _encode_file(self,
+        src_path: str,
+        file_id: str,
+        date: str,
+        blob: bytes,
+        profile: bool,
+        header: _Header,
+        processors: list["ImageProcessor"]) -> tuple[list[bytes], Union[dict, None]]:
+        '''
+        Convert the image at `src_path` with every processor of `processors`, see `_convert`.
+
+        :return: The content of every formatted image, along with the record of the conversion when `profile`
+                 is set, whose `bytes_out` are those of every output.
+        '''
+        logger = logging.getLogger(__name__)
+        watch = Stopwatch() if profile else None
+        src_name = os.path.basename(src_path)
+        outputs = self._convert(
+            {"filename": src_path} if blob is None else {"blob": blob},
+            os.path.splitext(src_path)[1].lower() in REDUCED_DECODE_EXTENSIONS,
+            file_id,
+            date,
+            src_name,
+            watch,
+            header,
+            processors)
+        bytes_out = sum(len(output) for output in outputs)
+        if watch or logger.isEnabledFor(logging.DEBUG):
+            initial_size = len(blob) if blob is not None else os.path.getsize(src_path)
+            logger.debug(f"Reduced size of file {src_name} from {initial_size / 1000000} to {bytes_out / 1000000}") # sizes in Mb
+        if not watch:
+            return outputs, None
+        return outputs, {
+            "image":     src_path,
+            "output":    None,
+            "bytes_in":  initial_size,
+            "bytes_out": bytes_out,
+            "stages":    watch.stages
+        }
+
+    def _output_settings(self, resolution: tuple[float, float], height: int) -> tuple[tuple[int, int], float, int, int]:
+        '''
+        The output resolution, stamp size, stamp border width and offset of an image of the given `resolution`
+        and `height`, guessed when the output resolution is not set, see `_guess_output_settings`.
+        '''
+        if not self.output_resolution:
+            return _guess_output_settings(resolution, height)
+        return self.output_resolution, self.stamp_size or height * 0.05, self.stamp_border_width, self.offset
+
+    def _renditions_settings(self,
+        renditions: list["ImageProcessor"],
+        resolution: tuple[float, float],
+        height: int) -> list[tuple[tuple[int, int], float, int, int]]:
+        '''
+        The output settings of every processor of `renditions`, the first one being the main output, see
+        `_output_settings`. The stamp size, border width and offset a rendition does not set itself, i.e.
+        which are those of the main output, are the ones of the main output scaled by the ratio of the heights
+        of the outputs, so that the stamp covers the same part of every rendition.
+        '''
+        main, *others = renditions
+        main_settings = main._output_settings(resolution, height)
+        main_resolution, main_stamp_size, main_border_width, main_offset = main_settings
+        settings = [main_settings]
+        for processor in others:
+            output_resolution, stamp_size, stamp_border_width, offset = processor._output_settings(resolution, height)
+            scale = output_resolution[1] / main_resolution[1]
+            if processor.stamp_size == main.stamp_size:
+                stamp_size = main_stamp_size * scale
+            if processor.stamp_border_width == main.stamp_border_width:
+                stamp_border_width = max(1, round(main_border_width * scale)) if main_border_width else 0
+            if processor.offset == main.offset:
+                offset = round(main_offset * scale)
+            settings.append((output_resolution, stamp_size, stamp_border_width, offset))
+        return settings
+
+    def _convert(self,
+        source: dict,
+        reduced_decode: bool,
+        file_id: str,
+        date: str,
+        src_name: str     = "image",
+        watch: Stopwatch  = None,
+        header: _Header   = None,
+        processors: list["ImageProcessor"] = None) -> Union[bytes, list[bytes]]:
+        '''
+        Decode an image, then resample, stamp and encode it with the backend of the processor. Formats
+        supporting it are decoded at reduced size when the outputs do not need every pixel of the source.
+
+        :param: source         (dict) -- Either `{"filename": ...}` or `{"blob": ...}`.
+        :param: reduced_decode (bool) -- Whether the source can be decoded at reduced size.
+        :param: src_name       (str)  -- The name of the source in logs.
+        :param: header     (_Header)  -- The header of the source, read from `source` when needed otherwise.
+        :param: processors     (list) -- The processors of the renditions of the image, which all use the
+                                         backend of this processor. The image is decoded once, covering every
+                                         rendition, and every rendition is derived from a copy of it.
+
+        :return: The content of the formatted image, or of every rendition when `processors` is set.
+        '''
+        logger = logging.getLogger(__name__)
+        backend  = get_backend(self.backend)
+        renditions: list[ImageProcessor] = processors or [self]
+        settings: list[tuple[tuple[int, int], float, int, int]] = None
+        size_hint = None
+        if reduced_decode:
+            # Only read the header to find out how many pixels the outputs need.
+            if not header:
+                header = backend.read_header(source)
+                if watch: watch.lap("header")
+            width, height, resolution = header.width, header.height, header.resolution
+            settings  = self._renditions_settings(renditions, resolution, height)
+            size_hint = tuple(max(sizes) for sizes in zip(*(
+                _output_size((width, height), resolution, output_resolution) for output_resolution, *_ in settings)))
+            if size_hint[0] >= width or size_hint[1] >= height:
+                size_hint = None
+            if size_hint and self.use_previews:
+                if "blob" not in source:
+                    source = {"blob": _read_source(source["filename"])}
+                preview = find_preview(source["blob"], (width, height), size_hint)
+                if preview:
+                    logger.debug(f"Decoding the embedded preview of image {src_name}")
+                    source = {"blob": preview}
+                if watch: watch.lap("header")
+        image = backend.decode(source, size_hint)
+        try:
+            if watch: watch.lap("decode")
+            decoded_width, decoded_height = backend.size(image)
+            if not size_hint:
+                width, height, resolution = decoded_width, decoded_height, backend.resolution(image)
+            elif decoded_width != width:
+                # The image was decoded at reduced size, or from its preview. Lower its resolution by the
+                # same factor so that it still covers the same physical size once resampled.
+                logger.debug(f"Decoded image {src_name} at reduced size {decoded_width}x{decoded_height}")
+                resolution = (
+                    (resolution[0] or DEFAULT_RESOLUTION) * decoded_width / width,
+                    (resolution[1] or DEFAULT_RESOLUTION) * decoded_height / height)
+            logger.info(f"Converting image {src_name} of size {width}x{height}")
+            if not settings:
+                settings = self._renditions_settings(renditions, resolution, height)
+            if len(renditions) > 1:
+                image = backend.hold(image) # every rendition reads the decoded image again.
+            outputs: list[bytes] = []
+            for index, (processor, (output_resolution, stamp_size, stamp_border_width, offset)) in enumerate(zip(renditions, settings)):
+                # The last rendition works on the decoded image itself, the others on a copy of it.
+                last      = index == len(renditions) - 1
+                rendition = image if last else backend.clone(image)
+                try:
+                    rendition = backend.resample(rendition, resolution, output_resolution)
+                    if watch: watch.lap("resample")
+                    rendition = backend.stamp(rendition, f"{date} {file_id}", processor.font, stamp_size, processor.stamp_color, processor.stamp_border_color, stamp_border_width, offset)
+                    if watch: watch.lap("stamp")
+                    outputs.append(processor._encode(backend, rendition, src_name))
+                    if watch: watch.lap("encode")
+                finally:
+                    if last:
+                        image = rendition
+                    else:
+                        backend.close(rendition)
+        finally:
+            backend.close(image)
+        return outputs if processors else outputs[0]
+
+    def _encode(self, backend: Backend, image, src_name: str = "image") -> bytes:
+        '''
+        Encode `image` in the output format. With `max_size`, the image is encoded in memory with the highest
+        quality of `QUALITY_RANGE` which fits, found by bisection. When even the lowest quality does not fit,
+        the resolution of the image is lowered and the search starts again, at most `MAX_ENCODES` encodes
+        in total.
+
+        :return: The content of the encoded image.
+        :raises: ValueError -- If the image does not fit `max_size` within `MAX_ENCODES` encodes.
+        '''
+        logger = logging.getLogger(__name__)
+        if not self.max_size:
+            return backend.encode(image, self.output_format, progressive = self.progressive)
+        image = backend.hold(image)
+        lossy: bool  = self.output_format.upper() in LOSSY_FORMATS
+        encodes: int = 0
+        def encode(quality: int = None) -> bytes:
+            nonlocal encodes
+            if encodes >= MAX_ENCODES:
+                raise ValueError(f"Could not encode image {src_name} in at most {self.max_size} bytes.")
+            encodes += 1
+            # The metadata and profiles of the source are not needed by the output.
+            return backend.encode(image, self.output_format, quality, self.progressive, strip = True)
+        while True:
+            # The highest quality is tried first as it often fits, then the lowest one to find out whether
+            # any quality fits at this resolution.
+            low, high = QUALITY_RANGE
+            smallest  = encode(high if lossy else None)
+            if len(smallest) <= self.max_size:
+                best = smallest
+            elif lossy and len(smallest := encode(low)) <= self.max_size:
+                # The lowest quality fits and the highest does not, bisect in between.
+                best = smallest
+                while high - low > 1 and encodes < MAX_ENCODES:
+                    quality = (low + high) // 2
+                    blob = encode(quality)
+                    if len(blob) <= self.max_size:
+                        low, best = quality, blob
+                    else:
+                        high = quality
+            else:
+                # The size of the output is roughly proportional to its amount of pixels.
+                scale = math.sqrt(self.max_size / len(smallest)) * 0.95
+                logger.debug(f"Lowering the resolution of image {src_name} by {scale:.2f} to fit {self.max_size} bytes")
+                x, y  = resolution = backend.resolution(image)
+                image = backend.hold(backend.resample(image, resolution, (x * scale, y * scale)))
+                continue
+            logger.debug(f"Encoded image {src_name} in {len(best)} bytes with {encodes} encode(s)")
+            return best
+
+@functools.lru_cache(maxsize = 16)
+def _processor(**settings) -> ImageProcessor:
+    return ImageProcessor(**settings)
+
+def format_image(
+    data: bytes,
+    file_id: str,
+    date: str,
+    font: str                          = "Arial",
+    output_format: str                 = "JPG",
+    offset: int                        = 5,
+    stamp_size: float                  = None,
+    stamp_color                        = "#FFFFFF",
+    stamp_border_color                 = "#000000",
+    stamp_border_width                 = 1,
+    output_resolution: tuple[int, int] = None,
+    max_size: int                      = None,
+    progressive: bool                  = False,
+    use_previews: bool                 = False,
+    backend: str                       = "wand") -> bytes:
+    '''
+    Format an image held in memory, without touching the disk. The processor of every configuration is
+    validated once and then reused, see `ImageProcessor`. Safe to call from multiple threads.
+
+    :param: data    (bytes) -- The content of the source image.
+    :param: file_id (str)   -- The ID of the file, stamped next to the date.
+    :param: date    (str)   -- The date to stamp on the image.
+
+    See `process_images` for the other parameters.
+
+    :return: The content of the formatted image, in `output_format`.
+    '''
+    processor = _processor(
+        font               = font,
+        output_format      = output_format,
+        offset             = offset,
+        stamp_size         = stamp_size,
+        stamp_color        = stamp_color,
+        stamp_border_color = stamp_border_color,
+        stamp_border_width = stamp_border_width,
+        output_resolution  = tuple(output_resolution) if output_resolution else None,
+        max_size           = max_size,
+        progressive        = progressive,
+        use_previews       = use_previews,
+        backend            = backend)
+    return processor.format_image(data, file_id, date)
+
+def _write_output(path: str, blob: bytes) -> None:
+    '''
+    Write `blob` to `path` atomically. It is written to a hidden temporary file of the same directory which
+    then replaces `path`, so that readers of the directory never see a partial output.
+    '''
+    directory, name = os.path.split(path)
+    temporary = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(temporary, "wb") as f:
+            f.write(blob)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def _output_path(out_directory: str, file_id: str, number: int, output_format: str) -> str:
+    return "{} - {}.{}".format(os.path.join(out_directory,file_id), number, output_format)
+
+def _timestamp(path: str, header: _Header = None) -> str:
+    '''
+    Generate the date to stamp on the image at `path` from its metadata. The capture date of `header`
+    takes precedence over the creation time of the file.
+    '''
+    if header and header.captured:
+        return header.captured.strftime("%d-%m-%Y")
+    return datetime.fromtimestamp(os.path.getctime(path)).strftime("%d-%m-%Y")
+
+def _walk(directory: str, recursive: bool = False, exclude: str = None, visited: set[str] = None) -> Iterator[os.DirEntry]:
+    '''
+    Yield the entries of `directory` as they are read, followed by those of its subdirectories
+    when `recursive` is set.
+
+    :param: directory (str)      -- The directory to walk.
+    :param: recursive (bool)     -- Whether to walk the subdirectories.
+    :param: exclude   (str)      -- The real path of a subdirectory not to walk, e.g. the output directory.
+    :param: visited   (set[str]) -- The real paths of the directories already walked. Symbolic links to a
+                                    directory already walked, e.g. to an ancestor, are not walked again.
+    '''
+    if visited is None:
+        visited = {os.path.realpath(directory)}
+    subdirectories: list[str] = []
+    try:
+        with os.scandir(directory) as dl:
+            for entry in dl:
+                if recursive and entry.is_dir():
+                    real = os.path.realpath(entry.path)
+                    if real != exclude and real not in visited:
+                        visited.add(real)
+                        subdirectories.append(entry.path)
+                    continue
+                yield entry
+    except FileNotFoundError as e:
+        raise ValueError(f"Directory {directory} does not exist")
+    for subdirectory in subdirectories:
+        yield from _walk(subdirectory, recursive, exclude, visited)
+
+def _read_source(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _prefetch(tasks: Iterable[_Task], depth: int) -> Iterator[tuple[_Task, Union[bytes, OSError]]]:
+    '''
+    Read the sources of `tasks` ahead of their conversion in a background thread, so that reading
+    from the disk overlaps with decoding and encoding. At most `depth` sources are held in memory.
+    A source which cannot be read is yielded with the error instead of its content.
+
+    :param: tasks (Iterable[_Task]) -- The tasks to read the sources of. Consumed by the background thread.
+    :param: depth (int)             -- The amount of sources to read ahead. `0` disables reading ahead,
+                                       in which case `None` is yielded instead of the content.
+    '''
+    if depth < 1:
+        for task in tasks:
+            yield task, None
+        return
+    buffer: queue.Queue      = queue.Queue(maxsize = depth)
+    stop: threading.Event    = threading.Event()
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def read() -> None:
+        try:
+            for task in tasks:
+                try:
+                    data = _read_source(task.path)
+                except OSError as e:
+                    data = e
+                if not put((task, data)):
+                    return
+        except BaseException as e:
+            put(e) # e.g. the source directory does not exist.
+            return
+        put(None)
+    reader = threading.Thread(target = read, name = "h2kf-prefetch", daemon = True)
+    reader.start()
+    try:
+        while (item := buffer.get()) is not None:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
 def process_images(
     src_directory: str, 
     out_directory: str,
@@ -31,7 +728,26 @@ def process_images(
     stamp_color                        = "#FFFFFF",
     stamp_border_color                 = "#000000",
     stamp_border_width                 = 1,
-    output_resolution: tuple[int, int] = None) -> None:
+    output_resolution: tuple[int, int] = None,
+    jobs: int                          = 1,
+    incremental: bool                  = False,
+    recursive: bool                    = False,
+    prefetch: int                      = 4,
+    profile: Profile                   = None,
+    processor: ImageProcessor          = None,
+    max_size: int                      = None,
+    progressive: bool                  = False,
+    use_previews: bool                 = False,
+    archive: str                       = None,
+    prescan: bool                      = False,
+    timestamp_source: str              = "ctime",
+    deduplicate: bool                  = False,
+    dedup_threshold: int               = None,
+    pool: ProcessPoolExecutor          = None,
+    resource_limits: dict[str, int]    = None,
+    memory_budget: int                 = None,
+    backend: str                       = "wand",
+    renditions: list[Rendition]        = None) -> dict[str, str]:
     '''
     Process the provided images, appling the transformations.
     Will automatically format the `datetime` with the ISO format suing `strftime`.
@@ -42,82 +758,311 @@ def process_images(
     :param: file_id        (str)   -- The ID of the file to output.
     :param: font           (str)   -- The path of a custom font to use.
     :param: stamp_size     (int)   -- The size of the date stamp in terms of pixels.
+    :param: jobs           (int)   -- The amount of worker processes converting images in parallel.
+    :param: incremental    (bool)  -- Whether to skip the images whose output is up-to-date according to the
+                                      manifest of `out_directory`, see `Manifest`.
+    :param: recursive      (bool)  -- Whether to also process the images in the subdirectories of `src_directory`.
+    :param: prefetch       (int)   -- The amount of images read ahead from the disk while converting. Only
+                                      applies when `jobs` is `1`, as workers read their own images.
+    :param: profile     (Profile)  -- Collects the duration of the stages of the conversion of every image
+                                      when set.
+    :param: processor (ImageProcessor) -- A processor to reuse instead of creating one from `font`,
+                                          `output_format`, `offset`, `stamp_*` and `output_resolution`.
+    :param: max_size         (int)  -- The maximum size of every output in bytes. Outputs are then stripped of
+                                       their metadata and encoded with the highest quality which fits, or
+                                       at a lower resolution if needed. An image which does not fit fails.
+    :param: progressive      (bool) -- Whether to encode JPEG outputs as progressive with optimized coding,
+                                       which usually makes them smaller.
+    :param: use_previews     (bool) -- Whether to decode the preview embedded in JPEG images instead of the
+                                       images themselves when it has enough pixels for the output, see
+                                       `find_preview`. Other images are always decoded in full.
+    :param: archive          (str)  -- The format of an archive to write the outputs to instead of writing them
+                                       to `out_directory`, one of `ARCHIVE_FORMATS`. The archive is written
+                                       to `out_directory` as `{file_id}.{archive}`, see `Archive`.
+    :param: prescan          (bool) -- Whether to read the headers of every image before converting any. Images
+                                       which cannot be converted are then rejected without being decoded, and
+                                       the largest images are converted first so that the workers finish
+                                       together. The outputs keep the numbering of the order the images are found in.
+    :param: timestamp_source (str)  -- The metadata the timestamps are generated from, either `ctime` for the
+                                       creation time of the files or `exif` for the capture date of the images.
+                                       Images without a capture date fall back to `ctime`. Reading the capture
+                                       date implies reading the headers as with `prescan`.
+    :param: deduplicate      (bool) -- Whether to skip the images which are duplicates of an image found before
+                                       them, see `find_duplicates`. Their outputs are not numbered.
+    :param: dedup_threshold  (int)  -- The maximum amount of bits by which the perceptual hashes of duplicates
+                                       differ. Images are only duplicates when their content is the same
+                                       when `None`. Implies `deduplicate`.
+    :param: pool (ProcessPoolExecutor) -- A pool to convert the images with instead of starting one, e.g. shared
+                                          by several calls. Its workers must have been initialized with
+                                          `processor`, see `_worker_init`. It is left running.
+    :param: resource_limits (dict[str, int]) -- The limits of the ImageMagick resources of the conversions, by
+                                                resource, one of `RESOURCE_LIMITS`. Sizes are in bytes. Once
+                                                `memory` is reached, ImageMagick holds pixels in memory-mapped
+                                                files up to `map`, then on `disk`. The limits of a `pool` are
+                                                those its workers were initialized with.
+    :param: memory_budget    (int)  -- The amount of memory in bytes the pixels of the images converted at once
+                                       may hold, see `MemoryBudget`. The cost of every image is estimated from
+                                       its header, which implies reading the headers as with `prescan`. Only
+                                       applies when converting images in parallel. A `MemoryBudget` can be
+                                       given instead to share it between runs.
+    :param: backend          (str)  -- The backend doing the pixel work, one of `BACKENDS`, see `Backend`.
+                                       `vips` streams images through libvips, which is usually faster and holds
+                                       far less memory. The resource limits only apply to `wand`.
+    :param: renditions (list[Rendition]) -- Additional outputs of every image, e.g. a small preview or an archive
+                                            copy in another format. Every image is decoded once, at a size covering
+                                            every output, and every rendition is derived from it. The stamp is scaled
+                                            to the size of every rendition unless the rendition sets its size, border
+                                            width or offset. The renditions are numbered like the main outputs.
+                                            Cannot be used with `incremental` or `archive`.
 
-    :return: None
+    :return: The path of the image every skipped duplicate is a duplicate of, by the path of the duplicate.
+    :raises: ProcessException      -- If one or more images could not be converted. Every other image
+                                      is still converted. The duplicates are then in the exception.
     '''
 
     if date and generate_timestamp: raise ValueError('''Cannot generate timestamp 
         and provide date. Either `date` must be `None`
         or `generate_timestamp` must be `False`.''')
     
-    if not wver.fonts(font):
-        raise ValueError(f"Font {font} not supported by system.")
-    if not wver.formats(output_format.upper()):
-        raise ValueError(f"Image output format {output_format} not supported by system.")
     if not date and not generate_timestamp:
         raise ValueError("Must either provide `date` or `timestamp`.")
-    if output_resolution:
-        if not type(output_resolution) is tuple and not type(output_resolution) is list:
-            raise TypeError("`output_resolution` must be a tuple of (x-res, y-res).")
-        if len(output_resolution) != 2:
-            raise ValueError("`output_resolution must of a 2-tuple.")
+    if jobs < 1:
+        raise ValueError("`jobs` must be at least 1.")
+    if prefetch < 0:
+        raise ValueError("`prefetch` cannot be negative.")
+    if archive and archive not in ARCHIVE_FORMATS:
+        raise ValueError(f"`archive` must be one of {', '.join(ARCHIVE_FORMATS)}.")
+    if archive and incremental:
+        raise ValueError("Cannot convert incrementally to an archive, as the archive is written again by every run.")
+    if timestamp_source not in TIMESTAMP_SOURCES:
+        raise ValueError(f"`timestamp_source` must be one of {', '.join(TIMESTAMP_SOURCES)}.")
+    if pool and not processor:
+        raise ValueError("`processor` must be the processor the workers of `pool` were initialized with.")
+    if dedup_threshold is not None and not 0 <= dedup_threshold <= 64:
+        raise ValueError("`dedup_threshold` must be between 0 and 64 bits.")
+    _check_limits(resource_limits)
+    parallel: bool       = jobs > 1 or pool is not None
+    budget: MemoryBudget = None
+    if memory_budget is not None and parallel:
+        budget = memory_budget if isinstance(memory_budget, MemoryBudget) else MemoryBudget(memory_budget)
+
+    if not processor:
+        processor = ImageProcessor(
+            font               = font,
+            output_format      = output_format,
+            offset             = offset,
+            stamp_size         = stamp_size,
+            stamp_color        = stamp_color,
+            stamp_border_color = stamp_border_color,
+            stamp_border_width = stamp_border_width,
+            output_resolution  = output_resolution,
+            max_size           = max_size,
+            progressive        = progressive,
+            use_previews       = use_previews,
+            backend            = backend)
 
     logger = logging.getLogger(__name__)
 
-    IMAGE_PATTERN: str = "(\.png)|(\.jpg)|(\.heic)|(\.jpeg)$"
+    # The processor and output directory of every rendition.
+    extra: list[tuple[ImageProcessor, str]] = []
+    if renditions:
+        if incremental or archive:
+            raise ValueError("Renditions cannot be converted incrementally nor to an archive.")
+        outputs = {(os.path.realpath(out_directory), processor.output_format.upper())}
+        for rendition in renditions:
+            settings = rendition.settings or {}
+            unknown  = set(settings) - set(vars(processor))
+            if unknown:
+                raise ValueError(f"Renditions do not have the settings {', '.join(sorted(unknown))}.")
+            if settings.get("backend", processor.backend) != processor.backend:
+                raise ValueError("Renditions are derived from the image decoded by the backend of the main output.")
+            rendition_processor = ImageProcessor(**dict(vars(processor), **settings))
+            directory = os.path.join(out_directory, rendition.out_directory)
+            if not os.path.isdir(directory):
+                # Checked before converting, as every image would otherwise fail after writing its main output.
+                raise ValueError(f"Directory {directory} of the rendition does not exist")
+            output    = (os.path.realpath(directory), rendition_processor.output_format.upper())
+            if output in outputs:
+                raise ValueError(f"The outputs of the rendition in {directory} would replace other outputs.")
+            outputs.add(output)
+            extra.append((rendition_processor, directory))
+    def rendered(task: _Task) -> list[tuple[ImageProcessor, str]]:
+        return [(rendition, _output_path(directory, file_id, task.number, rendition.output_format)) for rendition, directory in extra]
 
-    try:
-        with os.scandir(src_directory) as dl:
-            for index, file in enumerate(dl):
-                if not re.search(IMAGE_PATTERN,file.name, re.IGNORECASE):
-                    logger.warning('Skipping file {} as it is not an image.'.format(file.name))
+    # The parameters which shape the outputs, see `Manifest`.
+    options: dict = dict(vars(processor), file_id = file_id)
+
+    manifest: Manifest = Manifest(out_directory) if incremental else None
+    scan: bool         = prescan or (generate_timestamp and timestamp_source == "exif") or budget is not None
+    deduplicate        = deduplicate or dedup_threshold is not None
+    duplicates: dict[str, str] = {}
+
+    def found() -> Iterator[tuple[int, os.DirEntry]]:
+        '''
+        Yield the images as they are found, along with the number of their output. Outputs are numbered
+        in the order in which the images are found, so that the numbering does not depend on the order
+        in which they are converted.
+        '''
+        exclude = os.path.realpath(out_directory)
+        for index, file in enumerate(_walk(src_directory, recursive, exclude)):
+            if not IMAGE_PATTERN.search(file.name):
+                logger.warning('Skipping file {} as it is not an image.'.format(file.name))
+                continue
+            yield index + 1, file
+
+    def plan() -> Iterator[_Task]:
+        '''
+        Yield the images to convert. When scanning, the headers are read first and the images which
+        cannot be converted are rejected. When deduplicating, every image is hashed first and the
+        duplicates are skipped.
+        '''
+        nonlocal date
+        files: Iterable[tuple[int, os.DirEntry]] = found()
+        if deduplicate:
+            files = list(files)
+            duplicates.update(find_duplicates([file.path for _, file in files], dedup_threshold))
+            for duplicate, original in duplicates.items():
+                logger.warning(f"Skipping image {os.path.basename(duplicate)} as it is a duplicate of {os.path.basename(original)}.")
+            files = [(number, file) for number, file in files if file.path not in duplicates]
+        images: Iterable[tuple[int, os.DirEntry, Union[_Header, Exception, None]]]
+        if scan:
+            files   = list(files)
+            headers = _scan_headers([file.path for _, file in files], get_backend(processor.backend))
+            images  = ((number, file, header) for (number, file), header in zip(files, headers))
+        else:
+            images = ((number, file, None) for number, file in files)
+        for number, file, header in images:
+            if isinstance(header, Exception):
+                count()
+                failed(file.path, header)
+                continue
+            if header and not processor.output_resolution:
+                try:
+                    _guess_output_settings(header.resolution, header.height)
+                except ValueError as e:
+                    count()
+                    failed(file.path, e)
                     continue
-                with Image(filename = file.path) as original:
-                    if generate_timestamp:
-                        date = datetime.fromtimestamp(os.path.getctime(file.path)).strftime("%d-%m-%Y")
-                        logger.debug(f"Generated timestamp {date} for image {file.name}")
-                    logger.info(f"Converting image {file.name} of size {original.width}x{original.height}")
-                    converted: Image = original.convert(output_format)
-                    if not stamp_size:
-                        stamp_size = original.height * 0.05
-                    if not output_resolution:
-                        logger.debug('''Attempting to guess output resolution
-                            of image as image resolution was not set. Original
-                            image resolution is %ix%i. Note that this also affects
-                            stamp_size and `stamp_border_width`''' % converted.resolution)
-                        res = max(converted.resolution)
-                        if res <= 72:
-                            output_resolution  = (25,25)
-                            stamp_size         = 0.03 * original.height
-                            stamp_border_width = 1
-                            offset             = 5
-                        elif res <= 102:
-                            output_resolution  = (70,70)
-                            stamp_size         = 0.03 * original.height
-                            stamp_border_width = 2
-                            offset             = 10
-                        elif res <= 500:
-                            output_resolution  = (200,200)
-                            stamp_size         = 0.03 * original.height
-                            stamp_border_width = 2
-                            offset             = 20
-                            logger.info("Image resolution is large. Consider explicitly supplying a different output resolution with `--output-resolution`.")
+            if generate_timestamp:
+                date = _timestamp(file.path, header if timestamp_source == "exif" else None)
+                logger.debug(f"Generated timestamp {date} for image {file.name}")
+            stat   = None
+            if manifest:
+                stat = file.stat()
+                if manifest.is_current(file.path, stat, dict(options, date = date)):
+                    logger.info(f"Skipping image {file.name} as its output is up-to-date.")
+                    continue
+                number = manifest.number(file.path)
+            output_path = _output_path(out_directory, file_id, number, processor.output_format)
+            task = _Task(file.name, file.path, output_path, date, number, stat, header)
+            if manifest:
+                manifest.plan(task.path, task.output_path, task.number)
+            yield task
+
+    def tasks() -> Iterable[_Task]:
+        if not prescan:
+            return plan()
+        return sorted(plan(), key = lambda task: task.header.width * task.header.height, reverse = True)
+
+    timed: bool                    = profile is not None
+    total: int                     = 0
+    failures: dict[str, Exception] = {}
+    # `plan` runs in the prefetch thread, which rejects images while this thread converts others.
+    lock: threading.Lock           = threading.Lock()
+    def count() -> None:
+        nonlocal total
+        with lock:
+            total += 1
+    def succeeded(task: _Task, record: dict) -> None:
+        if timed:
+            profile.add(record)
+        if manifest:
+            manifest.done(task.path, task.output_path, task.number, task.stat, dict(options, date = task.date))
+    def failed(path: str, e: Exception) -> None:
+        # Keyed by the path relative to the source directory, as images of subdirectories may share a name.
+        name = os.path.relpath(path, src_directory)
+        logger.error(f"Failed to convert image {name}: {e}")
+        with lock:
+            failures[name] = e
+    def store(task: _Task, output: bytes, record: dict) -> dict:
+        '''
+        Write the output of `task` to the archive. Only called from this thread, see `Archive`.
+        '''
+        watch = Stopwatch() if timed else None
+        entry = os.path.basename(task.output_path)
+        writer.add(entry, output)
+        if watch:
+            watch.lap("write")
+            record["output"] = os.path.join(writer.path, entry)
+            record["stages"].update(watch.stages)
+        return record
+
+    writer: Archive = Archive(os.path.join(out_directory, f"{file_id}.{archive}"), archive) if archive else None
+    try:
+        if not parallel:
+            with _resource_limits(resource_limits):
+                for task, blob in _prefetch(tasks(), prefetch):
+                    count()
+                    try:
+                        if isinstance(blob, OSError):
+                            raise blob
+                        if writer:
+                            record = store(task, *processor.encode_file(task.path, file_id, task.date, blob = blob, profile = timed, header = task.header))
                         else:
-                            raise ValueError("`output_resolution` must be specified for image of a resolution larger than 500 on either dimension.")
-                        logger.debug("Applying resolution %ix%i to output." % output_resolution)
-                    converted.resample(*output_resolution)
-                    with Drawing() as draw:
-                        draw.font = font
-                        draw.fill_color = Color(stamp_color)
-                        draw.stroke_color = Color(stamp_border_color)
-                        draw.stroke_width = stamp_border_width
-                        draw.font_size  = stamp_size
-                        draw.text(offset, converted.height - offset, f"{date} {file_id}")
-                        draw(converted)
-                    output_path = "{} - {}.{}".format(os.path.join(out_directory,file_id), index + 1, output_format)
-                    converted.save(filename=output_path)
-                    initial_size = os.path.getsize(file.path) / 1000000 # size in Mb
-                    final_size   = os.path.getsize(output_path) / 1000000 # size in Mb
-                    logger.debug(f"Reduced size of file {file.name} from {initial_size} to {final_size}")
-    except FileNotFoundError as e:
-        raise ValueError(f"Directory {src_directory} does not exist")
\ No newline at end of file
+                            record = processor.convert_file(task.path, task.output_path, file_id, task.date, blob = blob, profile = timed, header = task.header, renditions = rendered(task))
+                    except Exception as e:
+                        failed(task.path, e)
+                    else:
+                        succeeded(task, record)
+        else:
+            def collect(futures: Iterable[Future]) -> None:
+                for future in futures:
+                    task = pending.pop(future)
+                    try:
+                        record = store(task, *future.result()) if writer else future.result()
+                    except Exception as e:
+                        failed(task.path, e)
+                    else:
+                        succeeded(task, record)
+            with contextlib.nullcontext(pool) if pool else _process_pool(jobs, processor, resource_limits) as executor:
+                # Bound the amount of images submitted ahead so that memory does not grow with the
+                # size of the directory.
+                pending: dict[Future, _Task] = {}
+                for task in tasks():
+                    count()
+                    if len(pending) >= 2 * jobs:
+                        collect(wait(pending, return_when = FIRST_COMPLETED).done)
+                    cost = 0
+                    if budget:
+                        # The budget is released as soon as the conversion is done, even if it is not
+                        # collected yet, so that runs sharing the budget do not wait on one another.
+                        cost = _pixel_cost(task.header)
+                        if cost > budget.limit:
+                            logger.warning(f"Image {task.name} alone exceeds the memory budget, converting it alone.")
+                        budget.acquire(cost)
+                    try:
+                        if writer:
+                            future = executor.submit(_worker_encode, task.path, file_id, task.date, profile = timed, header = task.header)
+                        else:
+                            future = executor.submit(_worker_convert, task.path, task.output_path, file_id, task.date, profile = timed, header = task.header, renditions = rendered(task))
+                    except BaseException:
+                        if budget:
+                            budget.release(cost)
+                        raise
+                    if budget:
+                        future.add_done_callback(lambda future, cost = cost: budget.release(cost))
+                    pending[future] = task
+                collect(as_completed(list(pending)))
+    except BaseException:
+        if writer:
+            writer.close(discard = True)
+        raise
+    else:
+        if writer:
+            writer.close()
+    finally:
+        if manifest:
+            manifest.close()
+    if failures:
+        raise ProcessException(f"Failed to convert {len(failures)} of {total} images: {', '.join(sorted(failures))}", failures, duplicates)
+    return duplicates
@@ -0,0 +1,127 @@
+'''
+Manifest of the outputs written to an output directory, used to make runs incremental and resumable.
+'''
+import os
+import json
+import logging
+import threading
+
+MANIFEST_NAME: str = ".h2kf-manifest.jsonl"
+
+class Manifest:
+    '''
+    Journal of the images converted into an output directory. Every line of the manifest is a JSON record
+    for a source image, the last record of a source taking precedence over the previous ones:
+
+        {"source": ..., "output": ..., "number": ..., "done": ..., "size": ..., "mtime_ns": ..., "params": ...}
+
+    The number of the output of a source is recorded before the source is converted (`done` is then `false`),
+    so that an interrupted run resumes with the same numbering instead of duplicating outputs. Once the
+    conversion succeeds, the size and modification time of the source are recorded along with the parameters
+    that shaped the output, so that later runs can skip it as long as none of these change.
+
+    Sources are recorded by their real path, so that spelling the source directory differently, e.g. relative
+    or absolute, does not make every source look new and number it again.
+
+    Records are appended, hence a crash can at most truncate the last line, which is ignored when loading.
+    The manifest can be updated from multiple threads.
+    '''
+    def __init__(self, out_directory: str):
+        self.path: str                    = os.path.join(out_directory, MANIFEST_NAME)
+        self.entries: dict[str, dict]     = {}
+        self._logger: logging.Logger      = logging.getLogger(__name__)
+        self._numbers: set[int]           = set()
+        self._lock: threading.Lock        = threading.Lock()
+        self.load()
+        self._file                        = open(self.path, "a", encoding = "utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def load(self) -> None:
+        '''
+        Load the records of the manifest, if it exists.
+        '''
+        try:
+            with open(self.path, encoding = "utf-8") as f:
+                for line in f:
+                    try:
+                        record: dict = json.loads(line)
+                    except json.JSONDecodeError:
+                        self._logger.warning(f"Ignoring malformed record in manifest {self.path}")
+                        continue
+                    self.entries[os.path.realpath(record["source"])] = record
+        except FileNotFoundError:
+            pass
+        self._numbers = {entry["number"] for entry in self.entries.values()}
+
+    def is_current(self, source: str, stat: os.stat_result, params: dict) -> bool:
+        '''
+        Whether the output of `source` is up-to-date, i.e. it was written from the source in its current state
+        with the same `params` and it still exists.
+        '''
+        entry = self.entries.get(os.path.realpath(source))
+        return bool(entry
+            and entry["done"]
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+            and entry["params"] == _normalize(params)
+            and os.path.exists(entry["output"]))
+
+    def number(self, source: str) -> int:
+        '''
+        Get the number of the output of `source`. Sources which are not in the manifest yet are given the
+        number following the largest one in use.
+        '''
+        with self._lock:
+            entry = self.entries.get(os.path.realpath(source))
+            if entry:
+                return entry["number"]
+            number = max(self._numbers, default = 0) + 1
+            self._numbers.add(number)
+            return number
+
+    def plan(self, source: str, output: str, number: int) -> None:
+        '''
+        Record that `source` is about to be converted into `output`.
+        '''
+        self._write({
+            "source": os.path.realpath(source),
+            "output": output,
+            "number": number,
+            "done":   False
+        })
+
+    def done(self, source: str, output: str, number: int, stat: os.stat_result, params: dict) -> None:
+        '''
+        Record that `source` was successfully converted into `output` with `params`.
+        '''
+        self._write({
+            "source":   os.path.realpath(source),
+            "output":   output,
+            "number":   number,
+            "done":     True,
+            "size":     stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "params":   _normalize(params)
+        })
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _write(self, record: dict) -> None:
+        with self._lock:
+            self.entries[record["source"]] = record
+            self._numbers.add(record["number"])
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+def _normalize(params: dict) -> dict:
+    '''
+    Normalize the parameters to their JSON representation (e.g. tuples become lists) so that they can be
+    compared with the ones loaded from the manifest.
+    '''
+    return json.loads(json.dumps(params))
@@ -0,0 +1,146 @@
+'''
+Extraction of the previews embedded in JPEG images, which can be decoded instead of the image itself when
+they are large enough for the output.
+'''
+import struct
+
+from typing import Iterator, Union
+
+SOF_MARKERS: frozenset[int] = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC} # start of frame
+ASPECT_TOLERANCE: float     = 0.01 # relative difference of aspect ratio tolerated between a preview and its image
+
+def _segments(data: bytes) -> Iterator[tuple[int, int, int]]:
+    '''
+    Yield the marker, start and end of the payload of every segment of the JPEG image `data` up to its
+    pixel data.
+    '''
+    if data[:2] != b"\xff\xd8":
+        return
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return # corrupt, or not a JPEG image.
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1 # fill byte.
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            offset += 2 # markers without payload.
+            continue
+        if marker in (0xD9, 0xDA):
+            return # end of image, or start of the pixel data.
+        length, = struct.unpack_from(">H", data, offset + 2)
+        if offset + 2 + length > len(data):
+            return # truncated.
+        yield marker, offset + 4, offset + 2 + length
+        offset += 2 + length
+
+def jpeg_size(data: bytes) -> Union[tuple[int, int], None]:
+    '''
+    Read the size in pixels of the JPEG image `data` from its frame header.
+    '''
+    try:
+        for marker, start, end in _segments(data):
+            if marker in SOF_MARKERS and end - start >= 5:
+                height, width = struct.unpack_from(">HH", data, start + 1)
+                return width, height
+    except struct.error:
+        pass # truncated.
+    return None
+
+def _ifd(tiff: bytes, offset: int, order: str) -> tuple[dict[int, tuple[int, int, bytes]], int]:
+    '''
+    Read the image file directory of the TIFF structure `tiff` at `offset`.
+
+    :return: The type, count and raw value of every tag, and the offset of the next directory.
+    '''
+    count, = struct.unpack_from(order + "H", tiff, offset)
+    tags: dict[int, tuple[int, int, bytes]] = {}
+    for index in range(count):
+        entry = offset + 2 + index * 12
+        tag, kind, amount = struct.unpack_from(order + "HHI", tiff, entry)
+        tags[tag] = (kind, amount, tiff[entry + 8:entry + 12])
+    next_offset, = struct.unpack_from(order + "I", tiff, offset + 2 + count * 12)
+    return tags, next_offset
+
+def _tiff(tiff: bytes) -> tuple[str, int]:
+    '''
+    Read the byte order and the offset of the first directory of the TIFF structure `tiff`.
+    '''
+    order = {b"II": "<", b"MM": ">"}[tiff[:2]]
+    return order, struct.unpack_from(order + "I", tiff, 4)[0]
+
+def _exif_thumbnail(tiff: bytes) -> Union[bytes, None]:
+    # The thumbnail is described by the second directory (IFD1).
+    order, offset = _tiff(tiff)
+    _, offset = _ifd(tiff, offset, order)
+    if not offset:
+        return None
+    tags, _ = _ifd(tiff, offset, order)
+    if 0x0201 not in tags or 0x0202 not in tags:
+        return None
+    start,  = struct.unpack(order + "I", tags[0x0201][2])
+    length, = struct.unpack(order + "I", tags[0x0202][2])
+    thumbnail = tiff[start:start + length]
+    return thumbnail if len(thumbnail) == length else None
+
+def _mpf_images(data: bytes, base: int) -> Iterator[bytes]:
+    # The Multi-Picture Format describes the images following the primary image, whose offsets are
+    # relative to the start of its TIFF structure at `base`.
+    tiff = data[base:]
+    order, offset = _tiff(tiff)
+    tags, _ = _ifd(tiff, offset, order)
+    if 0xB002 not in tags:
+        return
+    _, length, value = tags[0xB002]
+    entries_offset, = struct.unpack(order + "I", value)
+    for index in range(length // 16):
+        _, size, start, _, _ = struct.unpack_from(order + "IIIHH", tiff, entries_offset + index * 16)
+        image = tiff[start:start + size]
+        if start and len(image) == size: # the primary image has no offset.
+            yield image
+
+def embedded_previews(data: bytes) -> list[bytes]:
+    '''
+    Extract the JPEG images embedded in the JPEG image `data`: the thumbnail of its EXIF metadata and the
+    images of its Multi-Picture Format metadata, where most phones store a large preview. Malformed
+    metadata is ignored.
+    '''
+    previews: list[bytes] = []
+    for marker, start, end in _segments(data):
+        try:
+            if marker == 0xE1 and data[start:start + 6] == b"Exif\0\0":
+                thumbnail = _exif_thumbnail(data[start + 6:end])
+                if thumbnail:
+                    previews.append(thumbnail)
+            elif marker == 0xE2 and data[start:start + 4] == b"MPF\0":
+                previews.extend(_mpf_images(data, start + 4))
+        except (struct.error, KeyError):
+            continue
+    return [preview for preview in previews if preview[:2] == b"\xff\xd8"]
+
+def find_preview(data: bytes, size: tuple[int, int], size_hint: tuple[int, int]) -> Union[bytes, None]:
+    '''
+    Find the smallest preview embedded in the JPEG image `data` which covers `size_hint`, see
+    `embedded_previews`. Previews whose aspect ratio differs from the one of the image are ignored,
+    as they are cropped or padded.
+
+    :param: data      (bytes)           -- The content of the image.
+    :param: size      (tuple[int, int]) -- The size of the image in pixels.
+    :param: size_hint (tuple[int, int]) -- The minimum size in pixels the preview must have.
+
+    :return: The content of the preview, or `None` if no preview is large enough.
+    '''
+    best: tuple[bytes, int] = None
+    for preview in embedded_previews(data):
+        preview_size = jpeg_size(preview)
+        if not preview_size:
+            continue
+        width, height = preview_size
+        if width < size_hint[0] or height < size_hint[1]:
+            continue
+        if abs(width * size[1] - height * size[0]) > ASPECT_TOLERANCE * width * size[1]:
+            continue
+        if not best or width * height < best[1]:
+            best = (preview, width * height)
+    return best[0] if best else None
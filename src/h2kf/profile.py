@@ -0,0 +1,79 @@
+'''
+Per-stage timing of the conversion of images.
+'''
+import json
+import math
+import time
+
+STAGES: tuple[str, ...] = ("header", "decode", "resample", "stamp", "encode", "write")
+
+class Stopwatch:
+    '''
+    Measures the time spent in each stage of the conversion of an image. Every call to `lap` attributes
+    the time elapsed since the previous one to the given stage.
+    '''
+    __slots__ = ("stages", "_last")
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self._last: float             = time.perf_counter()
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self._last
+        self._last = now
+
+class Profile:
+    '''
+    Collects the records of the images converted by `process_images` when passed as its `profile`.
+    Every record is a dictionary of the form:
+
+        {"image": ..., "output": ..., "bytes_in": ..., "bytes_out": ..., "stages": {"decode": ..., ...}}
+
+    where the duration of the stages is in seconds.
+    '''
+    def __init__(self):
+        self.records: list[dict] = []
+
+    def add(self, record: dict) -> None:
+        self.records.append(record)
+
+    def summary(self) -> str:
+        '''
+        Summarize the total, mean and 95th percentile duration of every stage, followed by the amount of
+        bytes read and written.
+        '''
+        durations: dict[str, list[float]] = {}
+        for record in self.records:
+            for stage, duration in record["stages"].items():
+                durations.setdefault(stage, []).append(duration)
+        stages = [stage for stage in STAGES if stage in durations] + sorted(set(durations) - set(STAGES))
+        lines = ["{:<10}{:>12}{:>12}{:>12}".format("stage", "total (s)", "mean (ms)", "p95 (ms)")]
+        for stage in stages:
+            values = durations[stage]
+            lines.append("{:<10}{:>12.3f}{:>12.2f}{:>12.2f}".format(
+                stage,
+                sum(values),
+                sum(values) / len(values) * 1000,
+                percentile(values, 95) * 1000))
+        bytes_in  = sum(record["bytes_in"] for record in self.records)
+        bytes_out = sum(record["bytes_out"] for record in self.records)
+        lines.append(f"{len(self.records)} images, {bytes_in / 1000000:.2f} MB in, {bytes_out / 1000000:.2f} MB out")
+        return "\n".join(lines)
+
+    def write_records(self, path: str) -> None:
+        '''
+        Write the records as JSON lines to `path`.
+        '''
+        with open(path, "w", encoding = "utf-8") as f:
+            for record in self.records:
+                f.write(json.dumps(record) + "\n")
+
+def percentile(values: list[float], p: float) -> float:
+    '''
+    Nearest-rank percentile of `values`.
+    '''
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
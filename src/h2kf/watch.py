@@ -0,0 +1,240 @@
+'''
+Long-running conversion of the images added to a directory.
+'''
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+
+from typing import Union
+
+from .image import (ImageProcessor, IMAGE_PATTERN, _Task, _walk, _output_path,
+    _timestamp, _process_pool, _worker_convert, _check_limits, _resource_limits)
+from .manifest import Manifest
+
+class _Inotify:
+    '''
+    Reports the files written to or moved into a directory using inotify (Linux only). Files are only
+    reported once they are closed, hence never while they are still being written.
+    '''
+    IN_CLOSE_WRITE: int   = 0x00000008
+    IN_MOVED_TO: int      = 0x00000080
+    IN_ISDIR: int         = 0x40000000
+    EVENT: struct.Struct  = struct.Struct("iIII") # wd, mask, cookie, len; followed by the name.
+
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        self.fd: int = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not initialize inotify.")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"Could not watch directory {directory}.")
+
+    def read(self, timeout: float) -> list[str]:
+        '''
+        Wait at most `timeout` seconds for files and return their paths.
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        paths: list[str] = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if name and not mask & self.IN_ISDIR:
+                paths.append(os.path.join(self.directory, os.fsdecode(name)))
+        return paths
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class _Poller:
+    '''
+    Reports the files added to or modified in a directory by listing it periodically, where inotify is not
+    available (e.g. other systems or network mounts). Files are only reported once their size and modification
+    time are the same on two consecutive listings, hence normally not while they are still being written.
+    '''
+    def __init__(self, directory: str, interval: float):
+        self.directory: str                           = directory
+        self.interval: float                          = interval
+        self._previous: dict[str, tuple[int, int]]    = self._list()
+        self._reported: dict[str, tuple[int, int]]    = dict(self._previous)
+        self._due: float                              = time.monotonic() + interval # time of the next listing.
+
+    def _list(self) -> dict[str, tuple[int, int]]:
+        files: dict[str, tuple[int, int]] = {}
+        with os.scandir(self.directory) as dl:
+            for entry in dl:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                except FileNotFoundError:
+                    pass # removed while listing.
+        return files
+
+    def read(self, timeout: float) -> list[str]:
+        '''
+        Wait for the next listing, at most `timeout` seconds, and return the paths of the files which
+        became stable since the previous one. The directory is listed every `interval` seconds whatever
+        `timeout`, hence nothing is returned when the next listing is not due within `timeout`.
+        '''
+        remaining = self._due - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, remaining))
+        self._due = time.monotonic() + self.interval
+        current = self._list()
+        paths: list[str] = []
+        for path, signature in current.items():
+            if self._previous.get(path) == signature and self._reported.get(path) != signature:
+                self._reported[path] = signature
+                paths.append(path)
+        self._previous = current
+        return paths
+
+    def close(self) -> None:
+        pass
+
+def _watcher(directory: str, poll: bool, poll_interval: float) -> Union[_Inotify, _Poller]:
+    logger = logging.getLogger(__name__)
+    if not poll:
+        try:
+            return _Inotify(directory)
+        except (OSError, AttributeError) as e: # AttributeError: libc without inotify.
+            logger.warning(f"Falling back to polling {directory} as inotify is not available: {e}")
+    return _Poller(directory, poll_interval)
+
+def watch_images(
+    src_directory: str,
+    out_directory: str,
+    file_id: str,
+    date: Union[str, None]             = None,
+    generate_timestamp: bool           = True,
+    jobs: int                          = 1,
+    poll: bool                         = False,
+    poll_interval: float               = 2.0,
+    processor: ImageProcessor          = None,
+    stop: threading.Event              = None,
+    resource_limits: dict[str, int]    = None,
+    **settings) -> None:
+    '''
+    Convert the images of `src_directory`, then keep converting the images added to it until `stop` is set
+    or the process is interrupted. The configuration is validated and the workers are started once, so that
+    new images are converted as soon as they are written.
+
+    The outputs are numbered and tracked by the manifest of `out_directory` like incremental runs of
+    `process_images`, hence images converted by a previous run are not converted again. Outputs are written
+    atomically so that consumers of `out_directory` never see a partial file.
+
+    :param: jobs          (int)             -- The amount of worker processes converting images in parallel.
+    :param: poll          (bool)            -- Whether to poll `src_directory` instead of using inotify, e.g.
+                                               for network mounts.
+    :param: poll_interval (float)           -- The interval between two listings of `src_directory` when
+                                               polling, in seconds.
+    :param: stop          (threading.Event) -- Stops watching once set.
+    :param: resource_limits (dict[str, int]) -- The limits of the ImageMagick resources of the conversions,
+                                                see `process_images`.
+
+    See `process_images` for the other parameters. The `settings` are those of `ImageProcessor`.
+
+    :return: None
+    '''
+    if date and generate_timestamp: raise ValueError('''Cannot generate timestamp
+        and provide date. Either `date` must be `None`
+        or `generate_timestamp` must be `False`.''')
+    if not date and not generate_timestamp:
+        raise ValueError("Must either provide `date` or `timestamp`.")
+    if jobs < 1:
+        raise ValueError("`jobs` must be at least 1.")
+    if not os.path.isdir(src_directory):
+        raise ValueError(f"Directory {src_directory} does not exist")
+    if os.path.realpath(src_directory) == os.path.realpath(out_directory):
+        raise ValueError("The output directory must differ from the watched directory.")
+    _check_limits(resource_limits)
+
+    logger = logging.getLogger(__name__)
+    processor = processor or ImageProcessor(**settings)
+    options: dict = dict(vars(processor), file_id = file_id)
+    stop = stop or threading.Event()
+    in_flight: set[str] = set()
+    lock = threading.Lock()
+
+    def plan(manifest: Manifest, path: str) -> Union[_Task, None]:
+        name = os.path.basename(path)
+        if not IMAGE_PATTERN.search(name) or path in in_flight:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None # removed since.
+        image_date = _timestamp(path) if generate_timestamp else date
+        if manifest.is_current(path, stat, dict(options, date = image_date)):
+            return None
+        number = manifest.number(path)
+        task = _Task(name, path, _output_path(out_directory, file_id, number, processor.output_format), image_date, number, stat)
+        manifest.plan(task.path, task.output_path, task.number)
+        return task
+
+    def finish(manifest: Manifest, task: _Task, future: Future) -> None:
+        with lock:
+            in_flight.discard(task.path)
+        if future.cancelled():
+            return # stopped before it started, converted by the next run.
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Failed to convert image {task.name}: {e}")
+        else:
+            logger.info(f"Converted image {task.name} to {task.output_path}")
+            manifest.done(task.path, task.output_path, task.number, task.stat, dict(options, date = task.date))
+
+    # Watch before listing the existing images so that no image is missed in between.
+    watcher = _watcher(src_directory, poll, poll_interval)
+    try:
+        with Manifest(out_directory) as manifest, _resource_limits(resource_limits):
+            pool: ProcessPoolExecutor = None
+            if jobs > 1:
+                pool = _process_pool(jobs, processor, resource_limits)
+            try:
+                paths: list[str] = [entry.path for entry in _walk(src_directory)]
+                logger.info(f"Watching {src_directory}")
+                while True:
+                    for path in paths:
+                        task = plan(manifest, path)
+                        if not task:
+                            continue
+                        with lock:
+                            in_flight.add(task.path)
+                        if pool:
+                            future = pool.submit(_worker_convert, task.path, task.output_path, file_id, task.date)
+                        else:
+                            future = Future()
+                            try:
+                                future.set_result(processor.convert_file(task.path, task.output_path, file_id, task.date))
+                            except Exception as e:
+                                future.set_exception(e)
+                        future.add_done_callback(lambda future, task = task: finish(manifest, task, future))
+                    if stop.is_set():
+                        break
+                    # The timeout only bounds how long stopping takes, see `_Poller.read`.
+                    paths = watcher.read(timeout = 1.0)
+            finally:
+                # Images which did not start yet are left to the next run.
+                if pool:
+                    pool.shutdown(wait = True, cancel_futures = True)
+    finally:
+        watcher.close()
@@ -0,0 +1,189 @@
+import unittest
+import os
+import sys
+import zlib
+import shutil
+import struct
+import tempfile
+import subprocess
+from unittest import mock
+from types import SimpleNamespace
+
+from src.h2kf.image import ImageProcessor, process_images
+from src.h2kf.backend import BACKENDS, WandBackend, VipsBackend, get_backend
+from src.h2kf.capabilities import CapabilityCache
+from src.h2kf.constants import BACKEND_NAMES
+
+'''
+NOTE: The conversions are real, hence every backend whose library is not installed is skipped. The source is a
+PNG image written by hand so that it does not depend on any backend. Every backend is checked against the same
+fixed outputs, so that the backends produce the same outputs even when only one of them is installed.
+'''
+
+FILE_ID: str                  = "2D45789"
+DATE: str                     = "10-08-2022"
+SRC_SIZE: tuple[int, int]     = (400, 300)
+SRC_RES: int                  = 72
+OUT_RES: tuple[int, int]      = (25, 25)
+OUT_SIZE: tuple[int, int]     = (139, 104) # SRC_SIZE resampled from SRC_RES to OUT_RES.
+TIMEOUT: float                = 120        # seconds, for the runs with worker processes.
+
+def _png(width: int, height: int, resolution: int) -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    rows = b"".join(b"\0" + bytes((200, 120, 40)) * width for _ in range(height))
+    ppm  = round(resolution / 0.0254) # pixels per metre
+    return b"".join((
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+        chunk(b"pHYs", struct.pack(">IIB", ppm, ppm, 1)),
+        chunk(b"IDAT", zlib.compress(rows)),
+        chunk(b"IEND", b"")))
+
+class TestBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.src_directory = tempfile.mkdtemp()
+        self.out_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.src_directory)
+        self.addCleanup(shutil.rmtree, self.out_directory)
+        patcher = mock.patch('src.h2kf.capabilities._capabilities', CapabilityCache(os.path.join(self.out_directory, "capabilities.json")))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with open(os.path.join(self.src_directory, "photo.png"), "wb") as f:
+            f.write(_png(*SRC_SIZE, SRC_RES))
+
+    def _backend(self, name: str):
+        '''
+        Get the backend `name`, skipping the test when it is not usable.
+        '''
+        try:
+            backend = get_backend(name)
+            backend.read_header({"filename": os.path.join(self.src_directory, "photo.png")})
+            ImageProcessor(backend = name)
+        except Exception as e:
+            self.skipTest(f"Backend {name} is not usable: {e}")
+        return backend
+
+    def _convert(self, name: str, output_resolution: tuple[int, int] = OUT_RES, **kwargs) -> tuple[list[str], tuple[int, int], tuple[float, float]]:
+        '''
+        Convert the source with the backend `name`, skipping the test when the backend is not usable. The
+        `kwargs` are those of `process_images`.
+
+        :return: The names of the outputs, and the size and resolution of the first one.
+        '''
+        backend = self._backend(name)
+        out_directory = os.path.join(self.out_directory, name)
+        os.mkdir(out_directory)
+        process_images(
+            self.src_directory,
+            out_directory,
+            FILE_ID,
+            date               = DATE,
+            generate_timestamp = False,
+            output_resolution  = output_resolution,
+            backend            = name,
+            **kwargs)
+        outputs = sorted(os.listdir(out_directory))
+        header  = backend.read_header({"filename": os.path.join(out_directory, outputs[0])})
+        return outputs, (header.width, header.height), header.resolution
+
+    def test_wand(self):
+        self.assertEqual(self._convert("wand"), ([f"{FILE_ID} - 1.JPG"], OUT_SIZE, (25.0, 25.0)))
+
+    def test_vips(self):
+        self.assertEqual(self._convert("vips"), ([f"{FILE_ID} - 1.JPG"], OUT_SIZE, (25.0, 25.0)))
+
+    def test_wand_guessed_resolution(self):
+        # A 72 DPI source is output at 25 DPI when the output resolution is not set, see `_guess_output_settings`.
+        self.assertEqual(self._convert("wand", None), ([f"{FILE_ID} - 1.JPG"], OUT_SIZE, (25.0, 25.0)))
+
+    def test_vips_guessed_resolution(self):
+        self.assertEqual(self._convert("vips", None), ([f"{FILE_ID} - 1.JPG"], OUT_SIZE, (25.0, 25.0)))
+
+    def _test_max_size(self, name: str):
+        # Stripping the metadata of the outputs must keep their resolution.
+        self.assertEqual(self._convert(name, max_size = 20000), ([f"{FILE_ID} - 1.JPG"], OUT_SIZE, (25.0, 25.0)))
+
+    def test_wand_max_size(self):
+        self._test_max_size("wand")
+
+    def test_vips_max_size(self):
+        self._test_max_size("vips")
+
+    def _test_jobs(self, name: str):
+        '''
+        Convert several images with worker processes, in a process of their own as a failing pool may hang.
+        '''
+        backend = self._backend(name)
+        for copy in ("photo 2.png", "photo 3.png"):
+            shutil.copy(os.path.join(self.src_directory, "photo.png"), os.path.join(self.src_directory, copy))
+        script = ("import sys; from src.h2kf.image import process_images; process_images(*sys.argv[1:4], "
+            "date = sys.argv[4], generate_timestamp = False, output_resolution = (25, 25), backend = sys.argv[5], jobs = 2)")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env  = dict(os.environ, XDG_CACHE_HOME = self.out_directory)
+        try:
+            subprocess.run(
+                [sys.executable, "-c", script, self.src_directory, self.out_directory, FILE_ID, DATE, name],
+                cwd     = root,
+                env     = env,
+                timeout = TIMEOUT,
+                check   = True)
+        except subprocess.TimeoutExpired:
+            self.fail(f"Converting with worker processes and backend {name} hangs.")
+        outputs = sorted(output for output in os.listdir(self.out_directory) if output.endswith(".JPG"))
+        self.assertEqual(outputs, [f"{FILE_ID} - {number}.JPG" for number in (1, 2, 3)])
+        for output in outputs:
+            header = backend.read_header({"filename": os.path.join(self.out_directory, output)})
+            self.assertEqual((header.width, header.height), OUT_SIZE)
+
+    def test_wand_jobs(self):
+        self._test_jobs("wand")
+
+    def test_vips_jobs(self):
+        self._test_jobs("vips")
+
+    def test_vips_stamp_baseline(self):
+        '''
+        The baseline of the stamp must be `offset` pixels from the bottom whether the text has descenders or
+        not, as with ImageMagick.
+        '''
+        backend = self._backend("vips")
+        offset  = 10
+        bottoms: list[int] = []
+        for file_id in (FILE_ID, "gjpqy"):
+            image = backend._pyvips.Image.black(400, 100, bands = 3).copy(interpretation = "srgb")
+            image = backend.stamp(image, f"{DATE} {file_id}", "sans", 40, "#FFFFFF", "#000000", 0, offset)
+            date  = image.crop(0, 0, 120, image.height) # the first digits of the date, which sit on the baseline.
+            bottoms.append(max(y for y in range(image.height) if date.crop(0, y, date.width, 1).max() > 0))
+        self.assertEqual(bottoms[0], bottoms[1])
+        self.assertAlmostEqual(bottoms[0], 100 - offset - 1, delta = 1)
+
+    def test_resolution_units(self):
+        '''
+        Every backend must read resolutions in DPI, rounded so that those stored in pixels per metre or
+        centimetre read as the DPI they were written with.
+        '''
+        wand = WandBackend()
+        self.assertEqual(wand.resolution(SimpleNamespace(resolution = (28.35, 28.35), units = "pixelspercentimeter")), (72.0, 72.0))
+        self.assertEqual(wand.resolution(SimpleNamespace(resolution = (96.0, 96.0), units = "pixelsperinch")), (96.0, 96.0))
+        self.assertEqual(wand.resolution(SimpleNamespace(resolution = (72.0, 72.0), units = "undefined")), (72.0, 72.0))
+        vips = VipsBackend.__new__(VipsBackend) # without importing pyvips, `resolution` does not need it.
+        self.assertEqual(vips.resolution(SimpleNamespace(xres = 2.835, yres = 2.835)), (72.0, 72.0))
+        self.assertEqual(vips.resolution(SimpleNamespace(xres = 1.0, yres = 1.0)), (0.0, 0.0))
+
+    def test_backend_names(self):
+        self.assertEqual(tuple(BACKENDS), BACKEND_NAMES)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            get_backend("gimp")
+        with self.assertRaises(ValueError):
+            ImageProcessor(backend = "gimp")
+
+    def test_missing_dependency(self):
+        get_backend.cache_clear()
+        self.addCleanup(get_backend.cache_clear)
+        with mock.patch.dict(sys.modules, {"pyvips": None}):
+            with self.assertRaises(ValueError):
+                get_backend("vips")
@@ -0,0 +1,93 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from unittest import mock
+
+from src.h2kf.batch import BatchJob, read_batch, process_batch, summarize
+from src.h2kf.image import ProcessException
+
+'''
+NOTE: The manifests are real files. The conversion of a file is mocked, the batch only being in charge of
+dispatching its files.
+'''
+
+ROWS: list[dict[str, str]] = [
+    {"src_directory": "photos/a", "out_directory": "out/a", "file_id": "2D45789", "date": "10-08-2022"},
+    {"src_directory": "photos/b", "out_directory": "out/b", "file_id": "2D45790", "date": "EXIF"}
+]
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _write(self, name: str, content: str) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def _expected(self) -> list[BatchJob]:
+        return [
+            BatchJob(os.path.join(self.directory, "photos/a"), os.path.join(self.directory, "out/a"), "2D45789", "10-08-2022", None),
+            BatchJob(os.path.join(self.directory, "photos/b"), os.path.join(self.directory, "out/b"), "2D45790", None, "exif")
+        ]
+
+    def test_read_csv(self):
+        lines = ["src_directory,out_directory,file_id,date"] + [",".join(row.values()) for row in ROWS]
+        path  = self._write("batch.csv", "\n".join(lines) + "\n")
+        self.assertEqual(read_batch(path), self._expected())
+
+    def test_read_json(self):
+        path = self._write("batch.json", json.dumps(ROWS))
+        self.assertEqual(read_batch(path), self._expected())
+
+    def test_read_invalid(self):
+        with self.assertRaises(ValueError):
+            read_batch(self._write("batch.json", json.dumps([{"src_directory": "photos/a", "file_id": "2D45789"}])))
+        with self.assertRaises(ValueError):
+            read_batch(self._write("batch.json", json.dumps({"rows": ROWS})))
+        with self.assertRaises(ValueError):
+            read_batch(self._write("batch.txt", ""))
+
+    @mock.patch('src.h2kf.batch.process_images')
+    def test_process(self, m_process_images):
+        failure = ProcessException("Failed to process 1 images.", {"c.jpg": RuntimeError("corrupt image")}, {"d.jpg": "e.jpg"})
+        m_process_images.side_effect = [{"b.jpg": "a.jpg"}, failure]
+        processor = mock.Mock()
+        batch     = self._expected()
+        results   = process_batch(batch, processor = processor, prefetch = 0)
+        self.assertEqual([result.job for result in results], batch)
+        self.assertEqual(results[0].error, None)
+        self.assertEqual(results[0].duplicates, {"b.jpg": "a.jpg"})
+        self.assertIs(results[1].error, failure)
+        self.assertEqual(results[1].duplicates, {"d.jpg": "e.jpg"})
+        for call, job in zip(m_process_images.call_args_list, batch):
+            self.assertEqual(call.args, (job.src_directory, job.out_directory, job.file_id))
+            self.assertEqual(call.kwargs["generate_timestamp"], job.date is None)
+            self.assertIs(call.kwargs["processor"], processor)
+            self.assertEqual(call.kwargs["prefetch"], 0)
+        self.assertEqual(m_process_images.call_args_list[1].kwargs["timestamp_source"], "exif")
+        summary = summarize(results).splitlines()
+        self.assertTrue(summary[0].startswith("ok      2D45789"))
+        self.assertTrue(summary[2].startswith("failed  2D45790"))
+        self.assertEqual(summary[-1], "1 of 2 files converted, 1 failed")
+
+    @mock.patch('src.h2kf.batch._process_pool')
+    @mock.patch('src.h2kf.batch.process_images', return_value = {})
+    def test_process_shared_pool(self, m_process_images, m_pool):
+        pool    = m_pool.return_value.__enter__.return_value
+        results = process_batch(self._expected(), jobs = 2, processor = mock.Mock())
+        m_pool.assert_called_once()
+        self.assertEqual([result.error for result in results], [None, None])
+        for call in m_process_images.call_args_list:
+            self.assertIs(call.kwargs["pool"], pool)
+            self.assertEqual(call.kwargs["jobs"], 2)
+
+    def test_process_incremental_shared_output(self):
+        batch = [job._replace(out_directory = self.directory) for job in self._expected()]
+        with self.assertRaises(ValueError):
+            process_batch(batch, processor = mock.Mock(), incremental = True)
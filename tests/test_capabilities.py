@@ -0,0 +1,54 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from unittest import mock
+
+from src.h2kf.capabilities import CapabilityCache
+
+VERSION: str = "ImageMagick 7.1.0-0"
+
+@mock.patch('src.h2kf.capabilities.wver')
+class TestCapabilities(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "h2kf", "capabilities.json")
+
+    def _setup_wver(self, m_wver, version: str = VERSION):
+        m_wver.MAGICK_VERSION = version
+        m_wver.fonts.side_effect   = lambda font: [font] if font == "Arial" else []
+        m_wver.formats.side_effect = lambda output_format: [output_format]
+
+    def test_cached_across_runs(self, m_wver):
+        self._setup_wver(m_wver)
+        for _ in range(2):
+            # Every cache emulates a new run of h2kf.
+            capabilities = CapabilityCache(self.path)
+            self.assertTrue(capabilities.supports_font("Arial"))
+            self.assertFalse(capabilities.supports_font("Missing"))
+            self.assertTrue(capabilities.supports_format("jpg"))
+        self.assertEqual(m_wver.fonts.call_count, 2)
+        m_wver.formats.assert_called_once_with("JPG")
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {
+                "version": VERSION,
+                "fonts":   {"Arial": True, "Missing": False},
+                "formats": {"JPG": True}})
+
+    def test_invalidated_by_version(self, m_wver):
+        self._setup_wver(m_wver)
+        CapabilityCache(self.path).supports_font("Arial")
+        self._setup_wver(m_wver, "ImageMagick 7.1.1-0")
+        self.assertTrue(CapabilityCache(self.path).supports_font("Arial"))
+        self.assertEqual(m_wver.fonts.call_count, 2)
+
+    def test_corrupted(self, m_wver):
+        self._setup_wver(m_wver)
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as f:
+            f.write("{")
+        self.assertTrue(CapabilityCache(self.path).supports_font("Arial"))
+        m_wver.fonts.assert_called_once_with("Arial")
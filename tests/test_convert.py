@@ -7,8 +7,18 @@ import shlex
 import sys
 import io
 import re
+import tempfile
+import shutil
+import subprocess
+import tarfile
+import zipfile
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 
-from src.h2kf.image import process_images
+from src.h2kf.image import process_images, format_image, ProcessException, MemoryBudget, Rendition, _processor, _walk, MAX_ENCODES
+from src.h2kf.backend import _stamp_cache
+from src.h2kf.profile import Profile, STAGES
+from src.h2kf.capabilities import CapabilityCache
 from src.h2kf.cli import main
 
 '''
@@ -35,6 +45,8 @@ OUT_RES: tuple[int, int] = (25, 25)
 # Global Variables
 
 images: list        = {} # Emulate filesystem storage.
+mtimes: dict        = {} # Modification times of the source files which were 'modified'.
+exif: dict          = {} # EXIF metadata of the source files which have some.
 
 # mock classes
 
@@ -42,32 +54,66 @@ class m_Image:
     '''
     Mock class for image used throughout tests.
     '''
-    def __init__(self, filename: str):
-        self.filename: str                   = filename
+    def __init__(self, filename: str = None, blob: bytes = None, width: int = None, height: int = None, background = None):
+        self.options: dict                   = {}
+        if filename or blob:
+            self.read(filename, blob)
+        elif width:
+            # Simulating a blank image, e.g. the overlay of a stamp.
+            self.filename: str               = None
+            self.width: int                  = width
+            self.height: int                 = height
+            self.background                  = background
+            self._m_drawing                  = None
+    def read(self, filename: str = None, blob: bytes = None):
+        # NOTE: the blob of a mock file is its path, see `m_read_source`.
+        self.filename: str                   = filename or blob.decode()
         # Simulating an actual image.
         self.width: int                      = SRC_SIZE[0]
         self.height: int                     = SRC_SIZE[1]
         self.resolution: tuple[float, float] = SRC_RES
+        self.units: str                      = 'pixelsperinch'
         self.format: str                     = os.path.splitext(self.filename)[1][1:]
+        self.metadata: dict                  = exif.get(self.filename, {})
+        self.colorspace: str                 = 'srgb'
+        self.alpha_channel: bool             = False
+        self.compression_quality: int        = 0
+        self.interlace_scheme: str           = 'undefined'
+        # Simulating a JPEG decoder scaling the image down to the `jpeg:size` hint.
+        if 'jpeg:size' in self.options:
+            hint = [int(x) for x in self.options['jpeg:size'].split('x')]
+            for denominator in (8, 4, 2):
+                if self.width // denominator >= hint[0] and self.height // denominator >= hint[1]:
+                    self.width  //= denominator
+                    self.height //= denominator
+                    break
         # Simulating a drawing
         self._m_drawing                      = None
         # Simulating saving
         self._m_saved: bool                  = False
         self._m_filesize                     = ORIGINAL_SIZE
-        # Make the file exist
-        self.save(filename)
+        # Make the file exist. The image itself is modified in place when converting it.
+        copy(self).save(self.filename)
         # super().__init__(wand = None)
     def __enter__(self):
         return self
     def __exit__(self, type, value, traceback):
         pass
-    def convert(self, output_format):
-        c = copy(self)
-        c.format   = output_format
-        c._m_saved = False
-        return c
+    def make_blob(self):
+        return m_blob(self)
+    def close(self):
+        pass
+    def clone(self):
+        return copy(self)
+    def strip(self):
+        self.metadata = {}
+    def composite(self, image, left: int = 0, top: int = 0):
+        # Simulating the stamp overlay being composited onto the image.
+        self._m_drawing        = image._m_drawing
+        self._m_stamp_position = (left, top)
     def resample(self, width: float, height: float):
-        self.resolution  = (float(width), float(height))
+        self._m_resampled_from = self.resolution
+        self.resolution        = (float(width), float(height))
         self._m_filesize = CONVERTED_SIZE # simultate change in size.
     def save(self, filename: str = ""):
         # NOTE: filename is actually filepath.
@@ -75,6 +121,18 @@ class m_Image:
         self.filename = filename
         images.update({self.filename: self})
     
+class m_blob(bytes):
+    '''
+    Mock of an encoded image, keeping track of the image it was encoded from.
+    '''
+    def __new__(cls, image: m_Image):
+        # Encoded images are empty unless a quality was set, in which case their size is proportional to
+        # the quality and to the amount of pixels.
+        size = image.width * image.height * image.compression_quality // 10000
+        blob = super().__new__(cls, bytes(size))
+        blob._m_image = copy(image)
+        return blob
+
 class m_Drawing:
     '''
     Mock class for the drawing instance.
@@ -95,6 +153,13 @@ class m_Drawing:
             self.y    = y
             self.body = body
 
+    def get_font_metrics(self, image: m_Image, text: str):
+        return SimpleNamespace(
+            text_width  = len(text) * self.font_size / 2,
+            text_height = self.font_size,
+            ascender    = self.font_size * 0.8,
+            descender   = -self.font_size * 0.2)
+
     def draw(self, image: m_Image):
         image._m_drawing = self
 
@@ -115,9 +180,14 @@ class m_Drawing:
         pass
 
 class m_file:
-    def __init__(self, name: str, path: str):
-        self.name: str = name
-        self.path: str = path
+    def __init__(self, name: str, path: str, directory: bool = False):
+        self.name: str       = name
+        self.path: str       = path
+        self.directory: bool = directory
+    def is_dir(self, follow_symlinks: bool = True):
+        return self.directory
+    def stat(self):
+        return SimpleNamespace(st_size = ORIGINAL_SIZE, st_mtime_ns = mtimes.get(self.path, int(CTIME * 1e9)))
 
 class m_scandir_base():
     '''
@@ -144,6 +214,40 @@ class m_scandir_JPG(m_scandir_base):
         self.dir = dir
         self.suffix = f".{SRC_FMT}"
 
+class m_scandir_jpeg(m_scandir_base):
+    def __init__(self, dir: str):
+        self.dir = dir
+        self.suffix = ".jpg"
+
+class m_scandir_nested(m_scandir_JPG):
+    '''
+    Source directory containing a subdirectory with as many images as itself.
+    '''
+    def __enter__(self):
+        _files = super().__enter__()
+        if self.dir == SRC_DIR:
+            _files.insert(AMOUNT_FILES // 2, m_file(name = "nested", path = os.path.join(SRC_DIR, "nested"), directory = True))
+        return _files
+
+class m_ProcessPoolExecutor(ThreadPoolExecutor):
+    '''
+    Pool of workers emulated with threads, so that the mocks are shared with the workers.
+    '''
+    def __init__(self, max_workers: int, initializer = None, initargs: tuple = (), mp_context = None):
+        super().__init__(max_workers = max_workers, initializer = initializer, initargs = initargs)
+
+def m_read_source(path: str) -> bytes:
+    '''
+    Mock of reading the content of a source file. The content of a mock file is its path.
+    '''
+    return path.encode()
+
+def m_write_output(path: str, blob: m_blob) -> None:
+    '''
+    Mock of writing an encoded image to the disk.
+    '''
+    copy(blob._m_image).save(path)
+
 def m_getctime(path: str) -> float:
     '''
     Return an arbitrary ctime defined by a global variable. The `path` does not matter.
@@ -163,16 +267,30 @@ def m_getsize(filepath: str):
 def _get_mock_name(mock: mock.MagicMock) -> str:
     return vars(mock)['_mock_name']
 
-@mock.patch('src.h2kf.image.Image',            side_effect = m_Image)
-@mock.patch('src.h2kf.image.Drawing',          side_effect = m_Drawing)
+@mock.patch('src.h2kf.backend.Image',          side_effect = m_Image)
+@mock.patch('src.h2kf.backend.Drawing',        side_effect = m_Drawing)
 @mock.patch('src.h2kf.image.os.path.getctime', side_effect = m_getctime)
 @mock.patch("src.h2kf.image.os.path.getsize",  side_effect = m_getsize)
 @mock.patch('src.h2kf.image.os.scandir',       side_effect = m_scandir_JPG)
+@mock.patch('src.h2kf.image._read_source',     side_effect = m_read_source)
+@mock.patch('src.h2kf.image._write_output',    side_effect = m_write_output)
 class TestConvert(unittest.TestCase):
 
+    def setUp(self):
+        _stamp_cache.clear() # every test must render its own stamps.
+        _processor.cache_clear()
+        # Capabilities are cached in a temporary directory rather than the cache of the user.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        capabilities = mock.patch('src.h2kf.capabilities._capabilities', CapabilityCache(os.path.join(directory, "capabilities.json")))
+        capabilities.start()
+        self.addCleanup(capabilities.stop)
+
     def tearDown(self):
         global images
         images = {} # reset the images to ensure that the 'filesystem' is always cleaned up after tests.
+        mtimes.clear()
+        exif.clear()
 
     def _verify_args(self, args):
         '''
@@ -185,9 +303,11 @@ class TestConvert(unittest.TestCase):
                 arg.assert_called_with(SRC_DIR)
                 arg.assert_called_once()
             elif _get_mock_name(arg) == 'Image':
-                self.assertEqual(arg.call_count, AMOUNT_FILES)
+                # one image per file and one overlay for the stamp, which is the same for every file.
+                self.assertEqual(arg.call_count, AMOUNT_FILES + 1)
             elif _get_mock_name(arg) == 'Drawing':
-                self.assertEqual(arg.call_count, AMOUNT_FILES)
+                # the stamp is only rendered once.
+                self.assertEqual(arg.call_count, 1)
                 for call in arg.call_args_list:
                     self.assertEqual(call, ())
             elif _get_mock_name(arg) == 'getctime':
@@ -228,6 +348,9 @@ class TestConvert(unittest.TestCase):
                 self.assertEqual(image._m_drawing.fill_color.blue, 1.0)
                 self.assertEqual(image._m_drawing.font, 'Arial')
                 self.assertEqual(image._m_drawing.body, datetime.datetime.fromtimestamp(CTIME).strftime("%d-%m-%Y") + " " + FILE_ID)
+                # the baseline of the text is at `offset` from the bottom left corner.
+                self.assertEqual(image._m_stamp_position[0] + image._m_drawing.x, 5)
+                self.assertEqual(image._m_stamp_position[1] + image._m_drawing.y, image.height - 5)
             else:
                 self.fail("Image must be either a source image or an output image.")
 
@@ -246,8 +369,497 @@ class TestConvert(unittest.TestCase):
         self._verify_args(args)
         # Check images
         self._verify_images()
-    
-    @mock.patch('src.h2kf.cli.process_images', side_effect = process_images)
+
+    @mock.patch('src.h2kf.image.limits',              new = {})
+    @mock.patch('src.h2kf.image.ProcessPoolExecutor', new = m_ProcessPoolExecutor)
+    def test_convert_jobs(self, *args):
+        '''
+        The pool is emulated with threads so that the mocks are shared with the workers.
+        '''
+        process_images(
+            src_directory      = SRC_DIR,
+            out_directory      = OUT_DIR,
+            generate_timestamp = True,
+            output_format      = OUT_FMT,
+            file_id            = FILE_ID,
+            output_resolution  = OUT_RES,
+            jobs               = 4
+        )
+        self._verify_args(args)
+        self._verify_images()
+        # numbering must not depend on the order in which the workers complete.
+        self.assertEqual(
+            sorted(path for path in images if path.startswith(OUT_DIR)),
+            sorted(f"{os.path.join(OUT_DIR, FILE_ID)} - {i + 1}.{OUT_FMT}" for i in range(AMOUNT_FILES)))
+
+    @mock.patch('src.h2kf.image.limits',              new = {"memory": 1, "thread": 1})
+    @mock.patch('src.h2kf.image.ProcessPoolExecutor', new = m_ProcessPoolExecutor)
+    def test_convert_memory_budget(self, *args):
+        '''
+        The images converted at once must fit in the memory budget, estimated from their headers, and the
+        workers must apply the resource limits. Sequential runs must restore the limits once done.
+        '''
+        from src.h2kf.image import limits
+        m_image: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == 'Image')
+        m_image.ping.side_effect = m_Image
+        cost  = SRC_SIZE[0] * SRC_SIZE[1] * 3 * 4 # 3 channels of 4 bytes
+        peaks: list[int] = []
+        acquire = MemoryBudget.acquire
+        def m_acquire(self, amount: int) -> None:
+            acquire(self, amount)
+            peaks.append(self.used)
+        with mock.patch.object(MemoryBudget, 'acquire', autospec = True, side_effect = m_acquire):
+            process_images(
+                src_directory      = SRC_DIR,
+                out_directory      = OUT_DIR,
+                generate_timestamp = True,
+                output_format      = OUT_FMT,
+                file_id            = FILE_ID,
+                output_resolution  = OUT_RES,
+                jobs               = 4,
+                memory_budget      = 2 * cost,
+                resource_limits    = {"memory": 2 ** 30})
+        self._verify_images()
+        self.assertEqual(m_image.ping.call_count, AMOUNT_FILES)
+        self.assertEqual(len(peaks), AMOUNT_FILES)
+        self.assertLessEqual(max(peaks), 2 * cost)
+        self.assertEqual(limits["memory"], 2 ** 30)
+        limits["memory"] = 1
+        previous = dict(limits)
+        process_images(
+            src_directory      = SRC_DIR,
+            out_directory      = OUT_DIR,
+            generate_timestamp = True,
+            output_format      = OUT_FMT,
+            file_id            = FILE_ID,
+            output_resolution  = OUT_RES,
+            resource_limits    = {"memory": 2 ** 30})
+        self.assertEqual(limits, previous)
+        with self.assertRaises(ValueError):
+            process_images(SRC_DIR, OUT_DIR, FILE_ID, resource_limits = {"colors": 1})
+
+    @mock.patch('src.h2kf.image.limits',              new = {})
+    @mock.patch('src.h2kf.image.ProcessPoolExecutor', new = m_ProcessPoolExecutor)
+    def test_convert_archive(self, *args):
+        '''
+        Outputs must be streamed into the archive, from the conversion loop or from the workers, without
+        writing any intermediate file.
+        '''
+        out_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_directory)
+        expected = sorted(f"{FILE_ID} - {i + 1}.{OUT_FMT}" for i in range(AMOUNT_FILES))
+        for archive, jobs in (("zip", 1), ("tar.gz", 4)):
+            process_images(
+                src_directory      = SRC_DIR,
+                out_directory      = out_directory,
+                generate_timestamp = True,
+                output_format      = OUT_FMT,
+                file_id            = FILE_ID,
+                output_resolution  = OUT_RES,
+                jobs               = jobs,
+                archive            = archive)
+            path = os.path.join(out_directory, f"{FILE_ID}.{archive}")
+            if archive == "zip":
+                with zipfile.ZipFile(path) as f:
+                    self.assertEqual(sorted(f.namelist()), expected)
+            else:
+                with tarfile.open(path) as f:
+                    self.assertEqual(sorted(f.getnames()), expected)
+        self.assertEqual(sorted(os.listdir(out_directory)), [f"{FILE_ID}.tar.gz", f"{FILE_ID}.zip"])
+        m_write: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == '_write_output')
+        m_write.assert_not_called()
+
+    def test_convert_failure(self, *args):
+        '''
+        A failing image must not prevent the other images from being converted.
+        '''
+        resample = m_Image.resample
+        def m_resample(self, width, height):
+            if self.filename.endswith(FILENAME_PATTERN % 3 + f".{SRC_FMT}"):
+                raise RuntimeError("corrupt image")
+            resample(self, width, height)
+        with mock.patch.object(m_Image, 'resample', m_resample):
+            with self.assertRaises(ProcessException) as cm:
+                process_images(
+                    src_directory      = SRC_DIR,
+                    out_directory      = OUT_DIR,
+                    generate_timestamp = True,
+                    output_format      = OUT_FMT,
+                    file_id            = FILE_ID,
+                    output_resolution  = OUT_RES
+                )
+        self.assertEqual(list(cm.exception.failures), [FILENAME_PATTERN % 3 + f".{SRC_FMT}"])
+        self.assertEqual(len([path for path in images if path.startswith(OUT_DIR)]), AMOUNT_FILES - 1)
+
+    def test_convert_reduced_decode(self, *args):
+        '''
+        JPEG images must be decoded at the smallest size covering the output, and their resolution
+        lowered accordingly so that the output keeps the same size.
+        '''
+        m_image: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == 'Image')
+        m_image.ping.side_effect = m_Image
+        with mock.patch('src.h2kf.image.os.scandir', side_effect = m_scandir_jpeg):
+            process_images(
+                src_directory      = SRC_DIR,
+                out_directory      = OUT_DIR,
+                generate_timestamp = True,
+                output_format      = OUT_FMT,
+                file_id            = FILE_ID,
+                output_resolution  = OUT_RES
+            )
+        self.assertEqual(m_image.ping.call_count, AMOUNT_FILES)
+        for call in m_image.call_args_list:
+            if 'background' not in call.kwargs: # not the overlay of the stamp
+                self.assertEqual(call, ())
+        outputs = [image for path, image in images.items() if path.startswith(OUT_DIR)]
+        self.assertEqual(len(outputs), AMOUNT_FILES)
+        for image in outputs:
+            # 4032x3024 at 72 DPI resampled to 25 DPI needs 1400x1050 pixels.
+            self.assertEqual(image.options['jpeg:size'], "1400x1050")
+            self.assertEqual((image.width, image.height), (SRC_SIZE[0] // 2, SRC_SIZE[1] // 2))
+            self.assertEqual(image._m_resampled_from, (SRC_RES[0] / 2, SRC_RES[1] / 2))
+            self.assertEqual(image.resolution, OUT_RES)
+
+    @mock.patch('src.h2kf.manifest.os.path.exists', side_effect = lambda path: path in images)
+    def test_convert_incremental(self, *args):
+        '''
+        Images whose output is up-to-date must be skipped and modified images must keep their number.
+        '''
+        m_image: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == 'Image')
+        # NOTE: `os.scandir` is mocked, the directory can only be removed once the test is over.
+        out_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_directory)
+        def run(src_directory: str = SRC_DIR):
+            m_image.reset_mock()
+            process_images(
+                src_directory      = src_directory,
+                out_directory      = out_directory,
+                date               = "10-08-2022",
+                generate_timestamp = False,
+                output_format      = OUT_FMT,
+                file_id            = FILE_ID,
+                output_resolution  = OUT_RES,
+                incremental        = True
+            )
+        run()
+        self.assertEqual(m_image.call_count, AMOUNT_FILES + 1)
+        run()
+        self.assertEqual(m_image.call_count, 0)
+        # the sources are the same however the source directory is spelled.
+        run(os.path.join(os.path.dirname(SRC_DIR.rstrip("/")), ".", "directory", ""))
+        self.assertEqual(m_image.call_count, 0)
+        modified = os.path.join(SRC_DIR, FILENAME_PATTERN % 4 + f".{SRC_FMT}")
+        mtimes[modified] = int(CTIME * 1e9) + 1
+        run()
+        m_image.assert_called_once_with(blob = modified.encode())
+        self.assertEqual(len([path for path in images if path.startswith(out_directory)]), AMOUNT_FILES)
+        self.assertIn(f"{os.path.join(out_directory, FILE_ID)} - 5.{OUT_FMT}", images)
+
+    def test_convert_recursive(self, *args):
+        '''
+        Images in subdirectories must be found and numbered after the images of the source directory.
+        '''
+        with mock.patch('src.h2kf.image.os.scandir', side_effect = m_scandir_nested) as m_scandir:
+            process_images(
+                src_directory      = SRC_DIR,
+                out_directory      = OUT_DIR,
+                generate_timestamp = True,
+                output_format      = OUT_FMT,
+                file_id            = FILE_ID,
+                output_resolution  = OUT_RES,
+                recursive          = True
+            )
+        self.assertEqual(m_scandir.call_args_list, [mock.call(SRC_DIR), mock.call(os.path.join(SRC_DIR, "nested"))])
+        self.assertEqual(
+            sorted(path for path in images if path.startswith(OUT_DIR)),
+            sorted(f"{os.path.join(OUT_DIR, FILE_ID)} - {i + 1}.{OUT_FMT}" for i in range(2 * AMOUNT_FILES)))
+        self.assertIn(os.path.join(SRC_DIR, "nested", FILENAME_PATTERN % 0 + f".{SRC_FMT}"), images)
+
+    def test_convert_recursive_failure(self, *args):
+        '''
+        The failures of images sharing a name in different subdirectories must all be reported.
+        '''
+        resample = m_Image.resample
+        def m_resample(self, width, height):
+            if self.filename.endswith(FILENAME_PATTERN % 3 + f".{SRC_FMT}"):
+                raise RuntimeError("corrupt image")
+            resample(self, width, height)
+        with mock.patch('src.h2kf.image.os.scandir', side_effect = m_scandir_nested), \
+            mock.patch.object(m_Image, 'resample', m_resample):
+            with self.assertRaises(ProcessException) as cm:
+                process_images(
+                    src_directory      = SRC_DIR,
+                    out_directory      = OUT_DIR,
+                    generate_timestamp = True,
+                    output_format      = OUT_FMT,
+                    file_id            = FILE_ID,
+                    output_resolution  = OUT_RES,
+                    recursive          = True
+                )
+        name = FILENAME_PATTERN % 3 + f".{SRC_FMT}"
+        self.assertEqual(sorted(cm.exception.failures), [name, os.path.join("nested", name)])
+        self.assertIn(f"2 of {2 * AMOUNT_FILES} images", cm.exception.msg)
+
+    def test_convert_no_prefetch(self, *args):
+        m_read: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == '_read_source')
+        m_image: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == 'Image')
+        process_images(
+            src_directory      = SRC_DIR,
+            out_directory      = OUT_DIR,
+            generate_timestamp = True,
+            output_format      = OUT_FMT,
+            file_id            = FILE_ID,
+            output_resolution  = OUT_RES,
+            prefetch           = 0
+        )
+        self._verify_args(args)
+        self._verify_images()
+        m_read.assert_not_called()
+        # the sizes are only needed for debug logs.
+        next(arg for arg in args if _get_mock_name(arg) == 'getsize').assert_not_called()
+        self.assertIn(mock.call(filename = os.path.join(SRC_DIR, FILENAME_PATTERN % 0 + f".{SRC_FMT}")), m_image.call_args_list)
+
+    def test_convert_previews(self, *args):
+        '''
+        The embedded preview of a JPEG image must be decoded instead of the image when it is large enough,
+        the image being read once. Its resolution must be lowered so that it covers the same physical size.
+        '''
+        m_image: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == 'Image')
+        m_image.ping.side_effect = m_Image
+        def m_find_preview(data: bytes, size: tuple[int, int], size_hint: tuple[int, int]) -> bytes:
+            # NOTE: the content of a mock file is its path, the preview is then a mock file of its own.
+            return data + b" preview" if b"file 3" not in data else None
+        with mock.patch('src.h2kf.image.os.scandir', side_effect = m_scandir_jpeg), \
+            mock.patch('src.h2kf.image.find_preview', side_effect = m_find_preview) as m_find:
+            process_images(
+                src_directory      = SRC_DIR,
+                out_directory      = OUT_DIR,
+                generate_timestamp = True,
+                output_format      = OUT_FMT,
+                file_id            = FILE_ID,
+                output_resolution  = OUT_RES,
+                use_previews       = True,
+                prefetch           = 0)
+        self.assertEqual(m_find.call_count, AMOUNT_FILES)
+        for call in m_find.call_args_list:
+            self.assertEqual(call.args[1:], (SRC_SIZE, (1400, 1050)))
+        m_read: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == '_read_source')
+        self.assertEqual(m_read.call_count, AMOUNT_FILES)
+        decoded = [path for path in images if path.startswith(SRC_DIR) and path.endswith(" preview")]
+        self.assertEqual(len(decoded), AMOUNT_FILES - 1)
+        self.assertNotIn(os.path.join(SRC_DIR, "file 3.jpg preview"), decoded)
+        outputs = [image for path, image in images.items() if path.startswith(OUT_DIR)]
+        self.assertEqual(len(outputs), AMOUNT_FILES)
+        for image in outputs:
+            # The mock preview has as many pixels as the image once decoded at reduced size.
+            self.assertEqual(image._m_resampled_from, (SRC_RES[0] / 2, SRC_RES[1] / 2))
+            self.assertEqual(image.resolution, OUT_RES)
+
+    def test_convert_dedup(self, *args):
+        '''
+        Duplicates must be skipped without being read, leaving the numbering of the other images unchanged,
+        and be reported.
+        '''
+        path = lambda index: os.path.join(SRC_DIR, f"{FILENAME_PATTERN % index}.{SRC_FMT}")
+        found = {path(3): path(1), path(7): path(1), path(8): path(2)}
+        with mock.patch('src.h2kf.image.find_duplicates', return_value = found) as m_find:
+            duplicates = process_images(
+                src_directory      = SRC_DIR,
+                out_directory      = OUT_DIR,
+                generate_timestamp = True,
+                output_format      = OUT_FMT,
+                file_id            = FILE_ID,
+                output_resolution  = OUT_RES,
+                dedup_threshold    = 5)
+        m_find.assert_called_once_with([path(index) for index in range(AMOUNT_FILES)], 5)
+        self.assertEqual(duplicates, found)
+        m_read: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == '_read_source')
+        self.assertEqual(sorted(call.args[0] for call in m_read.call_args_list), sorted(set(map(path, range(AMOUNT_FILES))) - set(found)))
+        self.assertEqual(
+            sorted(path for path in images if path.startswith(OUT_DIR)),
+            sorted(f"{os.path.join(OUT_DIR, FILE_ID)} - {i + 1}.{OUT_FMT}" for i in range(AMOUNT_FILES) if i not in (3, 7, 8)))
+
+    def test_convert_prescan(self, *args):
+        '''
+        Headers must be read once, before converting any image. Images which cannot be converted must be
+        rejected without being decoded, the largest images converted first without changing the numbering,
+        and the capture dates used as timestamps when available.
+        '''
+        capture_date = "04-05-2021"
+        ctime_date   = datetime.datetime.fromtimestamp(CTIME).strftime("%d-%m-%Y")
+        for index in range(0, AMOUNT_FILES, 2):
+            exif[os.path.join(SRC_DIR, f"{FILENAME_PATTERN % index}.jpg")] = {"exif:DateTimeOriginal": "2021:05:04 10:11:12"}
+        def m_ping(filename: str = None, blob: bytes = None) -> m_Image:
+            image = m_Image(filename = filename, blob = blob)
+            index = int(re.search(r"file (\d+)", image.filename).group(1))
+            image.height = SRC_SIZE[1] + index # the last images are the largest.
+            if index == 3:
+                image.resolution = (600.0, 600.0) # needs an explicit output resolution.
+            return image
+        m_image: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == 'Image')
+        m_image.ping.side_effect = m_ping
+        with mock.patch('src.h2kf.image.os.scandir', side_effect = m_scandir_jpeg):
+            with self.assertRaises(ProcessException) as context:
+                process_images(
+                    src_directory      = SRC_DIR,
+                    out_directory      = OUT_DIR,
+                    generate_timestamp = True,
+                    output_format      = OUT_FMT,
+                    file_id            = FILE_ID,
+                    prescan            = True,
+                    timestamp_source   = "exif")
+        self.assertEqual(list(context.exception.failures), ["file 3.jpg"])
+        self.assertEqual(m_image.ping.call_count, AMOUNT_FILES)
+        m_read: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == '_read_source')
+        self.assertEqual(m_read.call_count, AMOUNT_FILES - 1)
+        self.assertNotIn(mock.call(os.path.join(SRC_DIR, "file 3.jpg")), m_read.call_args_list)
+        outputs = [path for path in images if path.startswith(OUT_DIR)]
+        self.assertEqual(outputs, [
+            f"{os.path.join(OUT_DIR, FILE_ID)} - {number}.{OUT_FMT}"
+            for number in range(AMOUNT_FILES, 0, -1) if number != 4])
+        for path in outputs:
+            index = int(re.search(r" - (\d+)\.", path).group(1)) - 1
+            self.assertEqual(images[path]._m_drawing.body, f"{capture_date if index % 2 == 0 else ctime_date} {FILE_ID}")
+
+    @mock.patch('src.h2kf.image.os.path.isdir', side_effect = lambda path: os.path.basename(path) != "missing")
+    def test_convert_renditions(self, *args):
+        '''
+        Every image must be decoded once for all of its renditions, each with its own settings and output
+        directory, and numbered like the main output. The stamp must be scaled to the size of every rendition
+        unless the rendition sets it.
+        '''
+        m_image: mock.MagicMock = next(arg for arg in args if _get_mock_name(arg) == 'Image')
+        process_images(
+            src_directory      = SRC_DIR,
+            out_directory      = OUT_DIR,
+            generate_timestamp = True,
+            output_format      = OUT_FMT,
+            file_id            = FILE_ID,
+            output_resolution  = OUT_RES,
+            renditions         = [
+                Rendition("previews", {"output_resolution": (10, 10)}),
+                Rendition("copies",   {"output_format": "PNG", "stamp_color": "#FF0000"}),
+                Rendition("thumbs",   {"output_resolution": (5, 5), "stamp_size": 12, "offset": 3})])
+        # one image per file and one overlay per stamp.
+        self.assertEqual(m_image.call_count, AMOUNT_FILES + 4)
+        for i in range(AMOUNT_FILES):
+            main    = images[f"{os.path.join(OUT_DIR, FILE_ID)} - {i + 1}.{OUT_FMT}"]
+            preview = images[f"{os.path.join(OUT_DIR, 'previews', FILE_ID)} - {i + 1}.{OUT_FMT}"]
+            png     = images[f"{os.path.join(OUT_DIR, 'copies', FILE_ID)} - {i + 1}.PNG"]
+            thumb   = images[f"{os.path.join(OUT_DIR, 'thumbs', FILE_ID)} - {i + 1}.{OUT_FMT}"]
+            self.assertEqual(main.resolution, OUT_RES)
+            self.assertEqual(preview.resolution, (10.0, 10.0))
+            self.assertEqual(png.resolution, OUT_RES)
+            self.assertEqual(png.format, "PNG")
+            self.assertEqual(main._m_drawing.fill_color.green, 1.0)
+            self.assertEqual(png._m_drawing.fill_color.green, 0.0)
+            self.assertEqual(main._m_resampled_from, SRC_RES) # not derived from another rendition.
+            self.assertEqual(main._m_drawing.font_size, SRC_SIZE[1] * 0.05)
+            self.assertEqual(preview._m_drawing.font_size, SRC_SIZE[1] * 0.05 * 10 / OUT_RES[1])
+            self.assertEqual(png._m_drawing.font_size, main._m_drawing.font_size)
+            self.assertEqual(thumb._m_drawing.font_size, 12)
+            # the baseline of the text is at `offset` from the bottom left corner.
+            self.assertEqual(main._m_stamp_position[0] + main._m_drawing.x, 5)
+            self.assertEqual(preview._m_stamp_position[0] + preview._m_drawing.x, 2)
+            self.assertEqual(thumb._m_stamp_position[0] + thumb._m_drawing.x, 3)
+        for renditions, kwargs in (
+            ([Rendition("previews", {"colour": "red"})], {}),
+            ([Rendition(".", {"output_resolution": (10, 10)})], {}),
+            ([Rendition("previews")], {"incremental": True}),
+            ([Rendition("missing")], {})):
+            with self.assertRaises(ValueError):
+                process_images(SRC_DIR, OUT_DIR, FILE_ID, renditions = renditions, **kwargs)
+        # the directories of the renditions are checked before converting any image.
+        self.assertEqual(m_image.call_count, AMOUNT_FILES + 4)
+
+    def test_convert_max_size(self, *args):
+        '''
+        Outputs must be stripped and encoded with the highest quality fitting the maximum size, within a
+        bounded amount of encodes. Images which cannot fit must fail.
+        '''
+        # The highest quality fitting 60000 bytes at 4032x3024 pixels is 49.
+        max_size = 60000
+        with mock.patch.object(m_Image, 'make_blob', autospec = True, side_effect = m_Image.make_blob) as m_make_blob:
+            process_images(
+                src_directory      = SRC_DIR,
+                out_directory      = OUT_DIR,
+                generate_timestamp = True,
+                output_format      = OUT_FMT,
+                file_id            = FILE_ID,
+                output_resolution  = OUT_RES,
+                max_size           = max_size,
+                progressive        = True)
+        self._verify_args(args)
+        outputs = [image for path, image in images.items() if path.startswith(OUT_DIR)]
+        self.assertEqual(len(outputs), AMOUNT_FILES)
+        for image in outputs:
+            self.assertEqual(image.compression_quality, 49)
+            self.assertEqual(image.interlace_scheme, 'plane')
+        self.assertLessEqual(m_make_blob.call_count, AMOUNT_FILES * MAX_ENCODES)
+        self.assertGreater(m_make_blob.call_count, AMOUNT_FILES * 2)
+        # Lowering the resolution does not shrink the mock images, hence they never fit.
+        images.clear()
+        with self.assertRaises(ProcessException) as context:
+            process_images(
+                src_directory      = SRC_DIR,
+                out_directory      = OUT_DIR,
+                generate_timestamp = True,
+                output_format      = OUT_FMT,
+                file_id            = FILE_ID,
+                output_resolution  = OUT_RES,
+                max_size           = 100)
+        self.assertEqual(len(context.exception.failures), AMOUNT_FILES)
+
+    def test_convert_profile(self, *args):
+        profile = Profile()
+        process_images(
+            src_directory      = SRC_DIR,
+            out_directory      = OUT_DIR,
+            generate_timestamp = True,
+            output_format      = OUT_FMT,
+            file_id            = FILE_ID,
+            output_resolution  = OUT_RES,
+            profile            = profile
+        )
+        self._verify_args(args)
+        self._verify_images()
+        self.assertEqual(len(profile.records), AMOUNT_FILES)
+        for record in profile.records:
+            # PNG images have no header stage as they are not decoded at reduced size.
+            self.assertEqual(list(record["stages"]), [stage for stage in STAGES if stage != "header"])
+            self.assertEqual(record["bytes_in"], len(m_read_source(record["image"])))
+        summary = profile.summary()
+        for stage in ("decode", "resample", "stamp", "encode", "write"):
+            self.assertIn(stage, summary)
+
+    @mock.patch('src.h2kf.capabilities.wver')
+    def test_format_image(self, m_wver, *args):
+        '''
+        Images held in memory must be formatted without touching the disk, validating the configuration once
+        even when called from multiple threads.
+        '''
+        m_wver.MAGICK_VERSION = "ImageMagick 7.1.0-0"
+        def format(index: int) -> m_blob:
+            return format_image(
+                f"/upload/photo {index}.{SRC_FMT}".encode(),
+                file_id           = f"{FILE_ID}-{index}",
+                date              = "10-08-2022",
+                output_format     = OUT_FMT,
+                output_resolution = OUT_RES)
+        format(0) # validate the configuration before the threads start.
+        with ThreadPoolExecutor(max_workers = 4) as pool:
+            outputs = list(pool.map(format, range(1, AMOUNT_FILES)))
+        m_wver.fonts.assert_called_once_with("Arial")
+        m_wver.formats.assert_called_once_with(OUT_FMT)
+        for index, output in enumerate(outputs, start = 1):
+            self.assertEqual(output._m_image.format, OUT_FMT)
+            self.assertEqual(output._m_image.resolution, OUT_RES)
+            self.assertEqual(output._m_image._m_drawing.body, f"10-08-2022 {FILE_ID}-{index}")
+        for arg in args:
+            if _get_mock_name(arg) in ('_read_source', '_write_output', 'scandir', 'getsize'):
+                arg.assert_not_called()
+
+    @mock.patch('h2kf.image.process_images', side_effect = process_images)
     def test_e2e(self, *args):
         command = f"h2kf.py image '{SRC_DIR}' '{OUT_DIR}' {FILE_ID} --generate-timestamp --output-format {OUT_FMT}"
         #NOTE: The first argument is the name of the executable.
@@ -266,13 +878,31 @@ class TestConvert(unittest.TestCase):
             "file_id": FILE_ID,
             "generate_timestamp": True,
             "output_format": OUT_FMT,
+            "output_resolution": None,
+            "jobs": 1,
+            "incremental": False,
+            "recursive": False,
+            "prefetch": 4,
+            "profile": None,
+            "max_size": None,
+            "progressive": False,
+            "use_previews": False,
+            "archive": None,
+            "prescan": False,
+            "timestamp_source": "ctime",
+            "deduplicate": False,
+            "dedup_threshold": None,
+            "resource_limits": None,
+            "memory_budget": None,
+            "backend": "wand",
+            "renditions": None,
             "date": None
         })
 
     def test_incorrect_args(self, *args):
 
         commands: dict[str, str] = {
-            "h2kf.py": "the following arguments are required: {image}",
+            "h2kf.py": "the following arguments are required: {image,watch,batch}",
             "h2kf.py image": "error: the following arguments are required: src_directory, out_directory, file_id",
             f"h2kf.py image '{SRC_DIR}' '{OUT_DIR}'": "error: the following arguments are required: file_id",
             f"h2kf.py image {SRC_DIR} {OUT_DIR} {FILE_ID}": "error: one of the arguments --date --generate-timestamp is required"
@@ -284,3 +914,48 @@ class TestConvert(unittest.TestCase):
             self.assertRaises(SystemExit, main)
             sys.stderr.seek(0)
             self.assertTrue(expected in sys.stderr.read())        
+
+class TestStartup(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        '''
+        Parsing the arguments must not load ImageMagick, so that short invocations start quickly.
+        '''
+        src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+        env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, (src, os.environ.get("PYTHONPATH")))))
+        result = subprocess.run(
+            [sys.executable, "-c", "import sys, h2kf.cli; print('wand' in sys.modules)"],
+            env            = env,
+            capture_output = True,
+            text           = True,
+            check          = True)
+        self.assertEqual(result.stdout.strip(), "False")
+
+    def test_lazy_exports(self):
+        '''
+        Probing the package must not load ImageMagick, while its public names are still exported.
+        '''
+        src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+        env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, (src, os.environ.get("PYTHONPATH")))))
+        result = subprocess.run(
+            [sys.executable, "-c", "import sys, h2kf; print(hasattr(h2kf, 'x'), 'wand' in sys.modules); from h2kf import *; print(process_images.__module__)"],
+            env            = env,
+            capture_output = True,
+            text           = True,
+            check          = True)
+        self.assertEqual(result.stdout.split(), ["False", "False", "h2kf.image"])
+
+class TestWalk(unittest.TestCase):
+
+    def test_walk_symlink_loop(self):
+        '''
+        A symbolic link to an ancestor must not be walked again.
+        '''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.mkdir(os.path.join(directory, "nested"))
+        for path in ("a.jpg", os.path.join("nested", "b.jpg")):
+            open(os.path.join(directory, path), "wb").close()
+        os.symlink(directory, os.path.join(directory, "nested", "loop"))
+        names = sorted(entry.name for entry in _walk(directory, recursive = True))
+        self.assertEqual(names, ["a.jpg", "b.jpg"])
@@ -0,0 +1,74 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from src.h2kf.dedup import find_duplicates, perceptual_hash
+
+'''
+NOTE: The files are real so that their content can be hashed. ImageMagick is mocked, the pixels of an image
+being derived from its content.
+'''
+
+# Grey levels of 9x8 images. The re-export differs from the original by a single pixel.
+GRADIENT: list[int]  = [(x * 28 + y) % 256 for y in range(8) for x in range(9)]
+REEXPORT: list[int]  = GRADIENT[:4] + [0] + GRADIENT[5:]
+DIFFERENT: list[int] = [(255 - x * 28 + y * 3) % 256 for y in range(8) for x in range(9)]
+PIXELS: dict[bytes, list[int]] = {
+    b"original":  GRADIENT,
+    b"re-export": REEXPORT,
+    b"other":     DIFFERENT
+}
+
+class m_Image:
+    def __init__(self):
+        self.options: dict = {}
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, traceback):
+        pass
+    def read(self, filename: str):
+        with open(filename, "rb") as f:
+            self.content = f.read()
+        if self.content not in PIXELS:
+            raise RuntimeError("corrupt image")
+    def transform_colorspace(self, colorspace: str):
+        pass
+    def resize(self, width: int, height: int):
+        self.size = (width, height)
+    def export_pixels(self, channel_map: str, storage: str) -> list[int]:
+        return PIXELS[self.content]
+
+@mock.patch('src.h2kf.dedup.Image', side_effect = m_Image)
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _add(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_content(self, m_image):
+        original = self._add("a.jpg", b"original")
+        copy     = self._add("b.jpg", b"original")
+        other    = self._add("c.jpg", b"original!")
+        same     = self._add("d.jpg", b"re-export") # same size, different content.
+        copy_2   = self._add("e.jpg", b"original")
+        self.assertEqual(find_duplicates([original, copy, other, same, copy_2]), {copy: original, copy_2: original})
+        m_image.assert_not_called()
+
+    def test_perceptual(self, m_image):
+        original = self._add("a.jpg", b"original")
+        other    = self._add("b.jpg", b"other")
+        reexport = self._add("c.jpg", b"re-export")
+        copy     = self._add("d.jpg", b"original")
+        corrupt  = self._add("e.jpg", b"corrupt")
+        self.assertEqual(bin(perceptual_hash(original) ^ perceptual_hash(reexport)).count("1"), 1)
+        paths = [original, other, reexport, copy, corrupt]
+        self.assertEqual(find_duplicates(paths, threshold = 0), {copy: original})
+        self.assertEqual(find_duplicates(paths, threshold = 5), {copy: original, reexport: original})
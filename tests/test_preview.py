@@ -0,0 +1,68 @@
+import unittest
+import struct
+
+from src.h2kf.preview import embedded_previews, find_preview, jpeg_size
+
+'''
+NOTE: The JPEG images are synthetic: they only hold the segments read by h2kf, not actual pixels.
+'''
+
+SIZE: tuple[int, int]      = (4032, 3024)
+HINT: tuple[int, int]      = (1400, 1050)
+THUMBNAIL: tuple[int, int] = (160, 120)
+PREVIEW: tuple[int, int]   = (1920, 1440)
+
+def segment(marker: int, payload: bytes) -> bytes:
+    return struct.pack(">BBH", 0xFF, marker, len(payload) + 2) + payload
+
+def jpeg(size: tuple[int, int], *segments: bytes) -> bytes:
+    sof = segment(0xC0, struct.pack(">BHHBBBB", 8, size[1], size[0], 1, 1, 0x11, 0))
+    return b"\xff\xd8" + b"".join(segments) + sof + segment(0xDA, b"\x00" * 8) + b"\x00" * 16 + b"\xff\xd9"
+
+def exif(thumbnail: bytes) -> bytes:
+    # Little-endian TIFF structure with an empty IFD0 followed by the IFD1 of the thumbnail.
+    ifd0 = struct.pack("<HI", 0, 14)
+    ifd1 = struct.pack("<HHHII", 2, 0x0201, 4, 1, 44) + struct.pack("<HHII", 0x0202, 4, 1, len(thumbnail)) + struct.pack("<I", 0)
+    return segment(0xE1, b"Exif\0\0" + b"II*\x00" + struct.pack("<I", 8) + ifd0 + ifd1 + thumbnail)
+
+def mpf(primary: int, preview: int, offset: int) -> bytes:
+    # Big-endian TIFF structure with the MP entries of the primary image and its preview.
+    ifd = struct.pack(">HHHII", 1, 0xB002, 7, 32, 26) + struct.pack(">I", 0)
+    entries = struct.pack(">IIIHH", 0x20030000, primary, 0, 0, 0) + struct.pack(">IIIHH", 0x00010002, preview, offset, 0, 0)
+    return segment(0xE2, b"MPF\0" + b"MM\x00*" + struct.pack(">I", 8) + ifd + entries)
+
+def phone_jpeg(preview_size: tuple[int, int] = PREVIEW) -> bytes:
+    '''
+    An image with an EXIF thumbnail and a preview appended after it, described by its MPF metadata.
+    '''
+    preview = jpeg(preview_size)
+    thumbnail = exif(jpeg(THUMBNAIL))
+    # The offset of the preview is relative to the TIFF structure of the MPF segment, which follows the
+    # start of image, the EXIF segment and the header of the MPF segment.
+    base = 2 + len(thumbnail) + 4 + 4
+    primary = jpeg(SIZE, thumbnail, mpf(0, 0, 0))
+    return jpeg(SIZE, thumbnail, mpf(len(primary), len(preview), len(primary) - base)) + preview
+
+class TestPreview(unittest.TestCase):
+
+    def test_embedded_previews(self):
+        previews = embedded_previews(phone_jpeg())
+        self.assertEqual([jpeg_size(preview) for preview in previews], [THUMBNAIL, PREVIEW])
+        self.assertEqual(jpeg_size(phone_jpeg()), SIZE)
+
+    def test_find_preview(self):
+        data = phone_jpeg()
+        self.assertEqual(jpeg_size(find_preview(data, SIZE, HINT)), PREVIEW)
+        self.assertEqual(jpeg_size(find_preview(data, SIZE, (100, 75))), THUMBNAIL)
+        # Too small for the output.
+        self.assertIsNone(find_preview(data, SIZE, (2000, 1500)))
+        # Cropped to another aspect ratio.
+        self.assertIsNone(find_preview(phone_jpeg((1920, 1080)), SIZE, HINT))
+
+    def test_malformed(self):
+        self.assertEqual(embedded_previews(b"not an image"), [])
+        self.assertEqual(embedded_previews(jpeg(SIZE)), [])
+        data = phone_jpeg()
+        # Truncated in the middle of the metadata.
+        self.assertEqual(embedded_previews(data[:60]), [])
+        self.assertIsNone(jpeg_size(data[:60]))
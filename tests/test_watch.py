@@ -0,0 +1,120 @@
+import unittest
+import os
+import time
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+from src.h2kf.image import _write_output
+from src.h2kf.watch import watch_images, _Poller
+from src.h2kf.manifest import MANIFEST_NAME
+
+'''
+NOTE: The directories are real as the watchers rely on the filesystem. ImageMagick is mocked by replacing
+the conversion of a file with a copy.
+'''
+
+FILE_ID: str   = "2D45789"
+DATE: str      = "10-08-2022"
+TIMEOUT: float = 10 # seconds
+
+def m_convert_file(self, src_path: str, output_path: str, file_id: str, date: str, blob: bytes = None, profile: bool = False):
+    _write_output(output_path, f"{date} {file_id}".encode())
+
+@mock.patch('src.h2kf.backend.supports_font',   return_value = True)
+@mock.patch('src.h2kf.backend.supports_format', return_value = True)
+@mock.patch('src.h2kf.image.ImageProcessor.convert_file', m_convert_file)
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.src_directory = tempfile.mkdtemp()
+        self.out_directory = tempfile.mkdtemp()
+        self.stop          = threading.Event()
+
+    def tearDown(self):
+        self.stop.set()
+        shutil.rmtree(self.src_directory)
+        shutil.rmtree(self.out_directory)
+
+    def _add(self, name: str) -> None:
+        with open(os.path.join(self.src_directory, name), "wb") as f:
+            f.write(b"image")
+
+    def _outputs(self) -> list[str]:
+        return sorted(name for name in os.listdir(self.out_directory) if name != MANIFEST_NAME)
+
+    def _wait_for(self, outputs: list[str]) -> None:
+        deadline = time.monotonic() + TIMEOUT
+        while self._outputs() != outputs:
+            if time.monotonic() > deadline:
+                self.fail(f"Expected outputs {outputs}, got {self._outputs()}")
+            time.sleep(0.05)
+
+    def _watch(self, **kwargs) -> threading.Thread:
+        thread = threading.Thread(target = watch_images, kwargs = dict(
+            src_directory      = self.src_directory,
+            out_directory      = self.out_directory,
+            file_id            = FILE_ID,
+            date               = DATE,
+            generate_timestamp = False,
+            stop               = self.stop,
+            **kwargs))
+        thread.start()
+        return thread
+
+    def _test_watch(self, **kwargs):
+        self._add("existing.jpg")
+        self._add("notes.txt")
+        thread = self._watch(**kwargs)
+        self._wait_for([f"{FILE_ID} - 1.JPG"])
+        self._add("new.png")
+        self._wait_for([f"{FILE_ID} - 1.JPG", f"{FILE_ID} - 2.JPG"])
+        self.stop.set()
+        thread.join(TIMEOUT)
+        self.assertFalse(thread.is_alive())
+        # A new run must not convert the images again, nor reuse their numbers.
+        self.stop.clear()
+        self._add("newer.heic")
+        thread = self._watch(**kwargs)
+        self._wait_for([f"{FILE_ID} - 1.JPG", f"{FILE_ID} - 2.JPG", f"{FILE_ID} - 3.JPG"])
+        self.stop.set()
+        thread.join(TIMEOUT)
+
+    def test_watch_inotify(self, *args):
+        self._test_watch()
+
+    def test_watch_poll(self, *args):
+        self._test_watch(poll = True, poll_interval = 0.1)
+
+    def test_poll_interval(self, *args):
+        '''
+        An interval longer than the timeout of the reads must still separate the listings, so that files are
+        only reported once stable for the whole interval.
+        '''
+        clock = [0.0]
+        def m_sleep(seconds: float) -> None:
+            clock[0] += seconds
+        with mock.patch('src.h2kf.watch.time') as m_time:
+            m_time.monotonic.side_effect = lambda: clock[0]
+            m_time.sleep.side_effect     = m_sleep
+            poller = _Poller(self.src_directory, 10.0)
+            self._add("new.jpg")
+            with mock.patch.object(poller, '_list', wraps = poller._list) as m_list:
+                reads = [poller.read(timeout = 1.0) for _ in range(20)]
+        self.assertEqual(m_list.call_count, 2)
+        self.assertEqual(clock[0], 20.0)
+        self.assertEqual(reads[19], [os.path.join(self.src_directory, "new.jpg")])
+        self.assertEqual(sum(reads, []), reads[19])
+
+    def test_watch_same_directory(self, *args):
+        with self.assertRaises(ValueError):
+            watch_images(self.src_directory, self.src_directory, FILE_ID, date = DATE, generate_timestamp = False)
+
+    def test_write_output_atomic(self, *args):
+        path = os.path.join(self.out_directory, "output.JPG")
+        _write_output(path, b"first")
+        _write_output(path, b"second")
+        self.assertEqual(os.listdir(self.out_directory), ["output.JPG"])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"second")